@@ -5,6 +5,10 @@ from flask_cors import CORS
 
 from config import DevelopmentConfig
 from .models import db
+from .cache import response_cache
+from .ratelimit import rate_limiter
+from .imaging import image_processor
+from .blocklist import revoked_tokens
 
 
 migrate = Migrate()
@@ -19,10 +23,28 @@ def create_blog():
     db.init_app(bg_app)
     migrate.init_app(bg_app, db)
     jwt.init_app(bg_app)
+    response_cache.init_app(bg_app)
+    rate_limiter.init_app(bg_app)
+    image_processor.init_app(bg_app)
+    revoked_tokens.init_app(bg_app)
+
+    from .storage import file_reaper
+    file_reaper.init_app(bg_app)
 
     from .routes import bp
     bg_app.register_blueprint(bp, url_prefix='/v1')
 
+    from .commands import reconcile_likes, rebuild_search_index, merge_duplicate_tags, dedupe_uploads, gc_uploads, shard_uploads, purge_invalid_tokens, import_blogs, reconcile_follows
+    bg_app.cli.add_command(reconcile_likes)
+    bg_app.cli.add_command(rebuild_search_index)
+    bg_app.cli.add_command(merge_duplicate_tags)
+    bg_app.cli.add_command(dedupe_uploads)
+    bg_app.cli.add_command(gc_uploads)
+    bg_app.cli.add_command(shard_uploads)
+    bg_app.cli.add_command(purge_invalid_tokens)
+    bg_app.cli.add_command(import_blogs)
+    bg_app.cli.add_command(reconcile_follows)
+
     with bg_app.app_context():
         db.create_all()
     return bg_app
\ No newline at end of file
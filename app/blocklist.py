@@ -0,0 +1,70 @@
+"""In-process view of the JWT blocklist used by `is_token_in_blocklist` in app/helper.py.
+
+Every authenticated request checks its jti. Instead of querying invalidtoken each time, each worker keeps the unexpired revoked
+jtis in memory and tops them up at most every JWT_BLOCKLIST_REFRESH seconds with the rows revoked since its last refresh.
+A token revoked in this worker is blocked straight away. One revoked in another worker may still pass here until the next refresh.
+Entries are dropped once their token has expired, because flask_jwt_extended rejects an expired token before the blocklist is asked.
+"""
+import threading
+import time
+
+from sqlalchemy import or_
+
+from .models import db, InvalidToken
+
+
+#Rows committed slightly out of revoked_at order (long transactions, clock skew between workers) are still picked up.
+OVERLAP = 60
+
+
+class RevokedTokens:
+    def __init__(self, refresh_interval=5):
+        self.refresh_interval = refresh_interval
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self._loaded_at = None
+
+    def init_app(self, app):
+        self.refresh_interval = app.config.get("JWT_BLOCKLIST_REFRESH", self.refresh_interval)
+        app.extensions["revoked_tokens"] = self
+
+    def add(self, jti, expires_at=None):
+        with self._lock:
+            self._tokens[jti] = expires_at
+
+    def is_revoked(self, jti):
+        now = time.time()
+
+        if self._loaded_at is None or now - self._loaded_at >= self.refresh_interval:
+            self.refresh(now)
+
+        with self._lock:
+            if jti not in self._tokens:
+                return False
+
+            expires_at = self._tokens[jti]
+            return expires_at is None or expires_at > now
+
+    def refresh(self, now=None):
+        """Loads every unexpired revoked token on the first call, then only those revoked since the previous call."""
+        now = now or time.time()
+        query = db.session.query(InvalidToken.jti, InvalidToken.expires_at)
+
+        if self._loaded_at is None:
+            query = query.filter(or_(InvalidToken.expires_at.is_(None), InvalidToken.expires_at > now))
+        else:
+            query = query.filter(InvalidToken.revoked_at >= self._loaded_at - OVERLAP)
+
+        rows = query.all()
+
+        with self._lock:
+            for jti, expires_at in rows:
+                self._tokens[jti] = expires_at
+
+            for jti in [jti for jti, expires_at in self._tokens.items() if expires_at is not None and expires_at <= now]:
+                del self._tokens[jti]
+
+            self._loaded_at = now
+
+
+revoked_tokens = RevokedTokens()
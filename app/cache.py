@@ -0,0 +1,102 @@
+"""In-process response cache used by the `cache` decorator in app/helper.py.
+
+Entries are kept in LRU order up to CACHE_MAX_ENTRIES and expire CACHE_TTL seconds after they were stored.
+Committed writes to any table in INVALIDATING_TABLES clear the cache, so results never outlive the data they were built from
+in the worker that made the change. Other workers rely on the TTL.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .session_info import discard_on_rollback
+
+
+INVALIDATING_TABLES = {"blog", "blog_search", "comment", "reply", "like", "tag", "user"}
+
+
+class ResponseCache:
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def init_app(self, app):
+        self.max_entries = app.config.get("CACHE_MAX_ENTRIES", self.max_entries)
+        self.ttl = app.config.get("CACHE_TTL", self.ttl)
+        app.extensions["response_cache"] = self
+
+        if not event.contains(Session, "after_flush", _record_writes):
+            event.listen(Session, "after_flush", _record_writes)
+            event.listen(Session, "after_commit", _invalidate_on_commit)
+            discard_on_rollback("written_tables")
+
+    def get(self, key):
+        """Returns the cached value for key, or None when it is missing or has expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+            }
+
+
+response_cache = ResponseCache()
+
+
+def _record_writes(session, flush_context):
+    tables = session.info.setdefault("written_tables", set())
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        tables.add(getattr(type(obj), "__tablename__", None))
+
+
+def _invalidate_on_commit(session):
+    tables = session.info.pop("written_tables", set())
+    if tables & INVALIDATING_TABLES:
+        response_cache.clear()
@@ -0,0 +1,526 @@
+import click
+import json
+import os
+import time
+from collections import Counter
+from datetime import datetime
+from flask.cli import with_appcontext
+from sqlalchemy import update, bindparam, select, delete, insert, func
+from sqlalchemy.orm import selectinload
+from sqlalchemy.exc import IntegrityError
+
+from .models import db, Blog, BlogSearch, Comment, Reply, Tag, tag_blog, img_blog, Image, User, StoredFile, InvalidToken, Follow
+from .helper import get_like_totals, normalize_tag, get_or_create_tags, img_extension_finder
+from .search import index_blog
+from .storage import upload_path, resolve_path, iter_uploads, hash_file, acquire_files, CONTENT_ADDRESSED, VARIANT_NAME, TEMP_PREFIX
+from . import timeline
+
+
+@click.command("reconcile-likes")
+@click.option("--batch-size", default=1000, show_default=True, help="Number of rows checked per query.")
+@with_appcontext
+def reconcile_likes(batch_size):
+    """Rebuilds the like_count of every blog, comment and reply from the like table.
+    Only rows whose counter has drifted are written back."""
+    for position, (model, name) in enumerate(((Blog, "blogs"), (Comment, "comments"), (Reply, "replies"))):
+        fixed = 0
+        last_id = 0
+
+        while True:
+            rows = db.session.query(model.id, model.like_count).filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+
+            last_id = rows[-1].id
+            ids = [[], [], []]
+            ids[position] = [row.id for row in rows]
+            totals = get_like_totals(*ids)[position]
+
+            drifted = [
+                {"row_id": row.id, "total": int(totals.get(row.id) or 0)}
+                for row in rows if row.like_count != int(totals.get(row.id) or 0)
+            ]
+
+            if drifted:
+                db.session.execute(
+                    update(model.__table__).where(model.__table__.c.id == bindparam("row_id")).values(like_count=bindparam("total")),
+                    drifted,
+                )
+                db.session.commit()
+                fixed += len(drifted)
+
+        click.echo(f"Reconciled {fixed} {name}.")
+
+
+@click.command("reconcile-follows")
+@click.option("--batch-size", default=1000, show_default=True, help="Number of users checked per query.")
+@with_appcontext
+def reconcile_follows(batch_size):
+    """Rebuilds follower_count and following_count of every user from the follow table, e.g. after upgrading an existing database.
+    Only users whose counters have drifted are written back."""
+    fixed = 0
+    last_id = 0
+
+    while True:
+        users = db.session.query(User.id, User.follower_count, User.following_count).filter(User.id > last_id).order_by(User.id).limit(batch_size).all()
+        if not users:
+            break
+
+        last_id = users[-1].id
+        ids = [user.id for user in users]
+        followers = dict(db.session.query(Follow.followed_user_id, func.count()).filter(Follow.followed_user_id.in_(ids)).group_by(Follow.followed_user_id))
+        following = dict(db.session.query(Follow.follower_user_id, func.count()).filter(Follow.follower_user_id.in_(ids)).group_by(Follow.follower_user_id))
+
+        drifted = [
+            {"row_id": user.id, "followers": followers.get(user.id, 0), "following": following.get(user.id, 0)}
+            for user in users
+            if (user.follower_count, user.following_count) != (followers.get(user.id, 0), following.get(user.id, 0))
+        ]
+
+        if drifted:
+            table = User.__table__
+            db.session.execute(
+                update(table).where(table.c.id == bindparam("row_id")).values(follower_count=bindparam("followers"), following_count=bindparam("following")),
+                drifted,
+            )
+            db.session.commit()
+            fixed += len(drifted)
+
+    click.echo(f"Reconciled {fixed} users.")
+
+
+@click.command("rebuild-search-index")
+@click.option("--batch-size", default=500, show_default=True, help="Number of blogs indexed per transaction.")
+@with_appcontext
+def rebuild_search_index(batch_size):
+    """Creates or refreshes the search row of every blog, e.g. after upgrading an existing database."""
+    indexed = 0
+    last_id = 0
+
+    while True:
+        blogs = Blog.query.options(selectinload(Blog.tags), selectinload(Blog.search_index)).filter(Blog.id > last_id).order_by(Blog.id).limit(batch_size).all()
+        if not blogs:
+            break
+
+        last_id = blogs[-1].id
+        for blog in blogs:
+            index_blog(blog)
+
+        db.session.commit()
+        indexed += len(blogs)
+
+    click.echo(f"Indexed {indexed} blogs.")
+
+
+@click.command("merge-duplicate-tags")
+@with_appcontext
+def merge_duplicate_tags():
+    """Merges tags that only differ in case or spacing into one dictionary entry and creates the tag indexes.
+    Blogs of the merged copies are re-linked to the surviving tag (the one with the lowest id)."""
+    groups = {}
+    for tag_id, name in db.session.query(Tag.id, Tag.name).order_by(Tag.id):
+        groups.setdefault(normalize_tag(name), []).append((tag_id, name))
+
+    merged = 0
+    for name, rows in groups.items():
+        keep_id = rows[0][0]
+        duplicate_ids = [tag_id for tag_id, _ in rows[1:]]
+
+        if duplicate_ids:
+            group_ids = [keep_id, *duplicate_ids]
+            blog_ids = {blog_id for (blog_id,) in db.session.execute(
+                select(tag_blog.c.blog_id).where(tag_blog.c.tag_id.in_(group_ids)).distinct()
+            )}
+
+            db.session.execute(delete(tag_blog).where(tag_blog.c.tag_id.in_(group_ids)))
+            if blog_ids:
+                db.session.execute(insert(tag_blog), [{"blog_id": blog_id, "tag_id": keep_id} for blog_id in blog_ids])
+            db.session.execute(delete(Tag.__table__).where(Tag.__table__.c.id.in_(duplicate_ids)))
+            merged += len(duplicate_ids)
+
+        if rows[0][1] != name:
+            db.session.execute(update(Tag.__table__).where(Tag.__table__.c.id == keep_id).values(name=name))
+
+    db.session.commit()
+
+    for index in (*Tag.__table__.indexes, *tag_blog.indexes):
+        index.create(db.engine, checkfirst=True)
+
+    click.echo(f"Merged {merged} duplicate tags into {len(groups)} tags.")
+
+
+@click.command("dedupe-uploads")
+@with_appcontext
+def dedupe_uploads():
+    """Moves images uploaded before content addressing under their content hash.
+    Identical legacy copies collapse into one stored file and the image and profile picture references are rewritten to it."""
+    legacy = {name for (name,) in db.session.query(Image.img_file_path).distinct()}
+    legacy |= {name for (name,) in db.session.query(User.profile_image).filter(User.profile_image.isnot(None)).distinct()}
+    legacy = sorted(name for name in legacy if not CONTENT_ADDRESSED.match(name))
+
+    moved = 0
+    for name in legacy:
+        path = resolve_path(name)
+        if path is None:
+            continue
+
+        sha256 = hash_file(path)
+
+        stored = db.session.get(StoredFile, sha256)
+        if stored is None:
+            extension = img_extension_finder(name) or "bin"
+            stored = StoredFile(sha256=sha256, filename=f"{sha256}.{extension.lower()}", size=os.path.getsize(path))
+            db.session.add(stored)
+
+        if resolve_path(stored.filename):
+            os.remove(path)
+        else:
+            os.makedirs(os.path.dirname(upload_path(stored.filename)), exist_ok=True)
+            os.replace(path, upload_path(stored.filename))
+
+        images = db.session.execute(update(Image.__table__).where(Image.__table__.c.img_file_path == name).values(img_file_path=stored.filename)).rowcount
+        users = db.session.execute(update(User.__table__).where(User.__table__.c.profile_image == name).values(profile_image=stored.filename)).rowcount
+        stored.ref_count = (stored.ref_count or 0) + images + users
+
+        db.session.commit()
+        moved += 1
+
+    click.echo(f"Moved {moved} legacy uploads under their content hash.")
+
+
+def _unreferenced(entries):
+    """Returns the entries of one scandir batch that no stored file, image or profile picture points at."""
+    names = [entry.name for entry in entries]
+    hashes = [match.group(1) for match in map(VARIANT_NAME.match, names) if match]
+
+    referenced = {name for (name,) in db.session.query(StoredFile.filename).filter(StoredFile.filename.in_(names))}
+    referenced |= {name for (name,) in db.session.query(Image.img_file_path).filter(Image.img_file_path.in_(names))}
+    referenced |= {name for (name,) in db.session.query(User.profile_image).filter(User.profile_image.in_(names))}
+    stored_hashes = {sha256 for (sha256,) in db.session.query(StoredFile.sha256).filter(StoredFile.sha256.in_(hashes))} if hashes else set()
+
+    orphans = []
+    for entry in entries:
+        variant = VARIANT_NAME.match(entry.name)
+        if entry.name.startswith((TEMP_PREFIX, ".variant-")):
+            orphans.append(entry)
+        elif variant:
+            if variant.group(1) not in stored_hashes:
+                orphans.append(entry)
+        elif entry.name not in referenced:
+            orphans.append(entry)
+
+    return orphans
+
+
+@click.command("gc-uploads")
+@click.option("--batch-size", default=1000, show_default=True, help="Number of files checked per query.")
+@click.option("--grace-period", default=24 * 60, show_default=True, help="Minutes a file must be old before it can be removed.")
+@click.option("--dry-run", is_flag=True, help="Only report what would be removed.")
+@with_appcontext
+def gc_uploads(batch_size, grace_period, dry_run):
+    """Removes files in UPLOAD_PATH and its shards that nothing references: leftovers of failed uploads, interrupted temp files and
+    variants of removed images. Files younger than the grace period are skipped, so uploads still in flight are safe."""
+    cutoff = time.time() - grace_period * 60
+    scanned = removed = freed = 0
+
+    def sweep(batch):
+        nonlocal removed, freed
+        for entry in _unreferenced(batch):
+            #Checked again after the database: save_upload touches a file it reuses before its row is committed.
+            try:
+                stat = os.stat(entry.path)
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime > cutoff:
+                continue
+
+            size = stat.st_size
+            if dry_run:
+                click.echo(f"would remove {entry.name} ({size} bytes)")
+            else:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+            removed += 1
+            freed += size
+
+    batch = []
+    for entry in iter_uploads():
+        if entry.stat().st_mtime > cutoff:
+            continue
+
+        scanned += 1
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            sweep(batch)
+            batch = []
+
+    if batch:
+        sweep(batch)
+
+    verb = "Would remove" if dry_run else "Removed"
+    click.echo(f"{verb} {removed} of {scanned} files older than the grace period, {freed} bytes.")
+
+
+@click.command("shard-uploads")
+@with_appcontext
+def shard_uploads():
+    """Moves files from the flat UPLOAD_PATH into their shard directories. Safe to run while the app serves traffic:
+    every move is a single rename and lookups check the sharded path both before and after the flat one."""
+    moved = 0
+
+    #depth=2 stops iter_uploads from descending, so only the flat files are listed.
+    for entry in iter_uploads(depth=2):
+        if entry.name.startswith((TEMP_PREFIX, ".variant-")):
+            continue
+
+        target = upload_path(entry.name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        if os.path.exists(target):
+            os.remove(entry.path)
+        else:
+            os.replace(entry.path, target)
+        moved += 1
+
+    click.echo(f"Moved {moved} uploads into shard directories.")
+
+
+@click.command("purge-invalid-tokens")
+@click.option("--batch-size", default=5000, show_default=True, help="Number of rows deleted per transaction.")
+@click.option("--legacy", is_flag=True, help="Also delete rows revoked before expiry times were stored. Those tokens have long expired unless JWT_ACCESS_TOKEN_EXPIRES is disabled.")
+@with_appcontext
+def purge_invalid_tokens(batch_size, legacy):
+    """Deletes revoked tokens that have expired. flask_jwt_extended rejects an expired token before the blocklist is checked,
+    so their rows are dead weight."""
+    condition = InvalidToken.expires_at <= int(time.time())
+    if legacy:
+        condition = condition | InvalidToken.expires_at.is_(None)
+
+    purged = 0
+    while True:
+        ids = [token_id for (token_id,) in db.session.query(InvalidToken.id).filter(condition).limit(batch_size)]
+        if not ids:
+            break
+
+        db.session.execute(delete(InvalidToken.__table__).where(InvalidToken.__table__.c.id.in_(ids)))
+        db.session.commit()
+        purged += len(ids)
+
+    click.echo(f"Purged {purged} expired tokens.")
+
+
+def _bulk_tags(names):
+    """Returns {name: Tag} for names, inserting every missing tag with one executemany."""
+    names = {normalize_tag(name) for name in names} - {""}
+    if not names:
+        return {}
+
+    tags = {tag.name: tag for tag in Tag.query.filter(Tag.name.in_(names))}
+    missing = names - tags.keys()
+
+    if missing:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(Tag.__table__), [{"name": name} for name in missing])
+        except IntegrityError:
+            #Some were created meanwhile, so fall back to creating them one by one.
+            pass
+        tags.update((tag.name, tag) for tag in get_or_create_tags(missing))
+
+    return tags
+
+
+def _parse_blog(record):
+    """Checks one import record and returns it with defaults filled in, or raises ValueError."""
+    if not isinstance(record, dict):
+        raise ValueError("record must be a JSON object")
+
+    for field in ("title", "content", "category"):
+        if not isinstance(record.get(field), str) or not record[field].strip():
+            raise ValueError(f"'{field}' is required")
+
+    if not record.get("author") and not record.get("user_id"):
+        raise ValueError("'author' (a username) or 'user_id' is required")
+
+    if record.get("author") and not isinstance(record["author"], str):
+        raise ValueError("'author' must be a string")
+
+    if record.get("user_id") and (not isinstance(record["user_id"], int) or isinstance(record["user_id"], bool)):
+        raise ValueError("'user_id' must be an integer")
+
+    tags = record.get("tags") or []
+    images = record.get("images") or []
+    if not isinstance(tags, list) or not isinstance(images, list):
+        raise ValueError("'tags' and 'images' must be lists")
+
+    if not all(isinstance(tag, str) for tag in tags):
+        raise ValueError("'tags' must be a list of strings")
+
+    published_date = record.get("published_date")
+    if published_date:
+        try:
+            published_date = datetime.fromisoformat(published_date)
+        except (TypeError, ValueError):
+            raise ValueError("'published_date' must be an ISO date e.g (2025-06-12)")
+
+    #Images are references to files already in UPLOAD_PATH, either a filename or {"name": ..., "file": ...}.
+    images = [image if isinstance(image, dict) else {"file": image} for image in images]
+    for image in images:
+        if not isinstance(image.get("file"), str) or resolve_path(image["file"]) is None:
+            raise ValueError(f"image '{image.get('file')}' is not in the upload directory")
+
+    return {**record, "tags": tags, "images": images, "published_date": published_date}
+
+
+def _insert_many(connection, table, rows, key):
+    """Inserts rows into table with one executemany and returns their ids in the same order.
+    MySQLdb can't return the ids of an executemany, so they are read back: the rows after the highest id seen before the
+    insert, matched on the key columns in id order (a multi-row INSERT numbers its rows in order)."""
+    floor = connection.execute(select(func.max(table.c.id))).scalar() or 0
+    connection.execute(insert(table), rows)
+
+    positions = {}
+    for position, row in enumerate(rows):
+        positions.setdefault(tuple(row[column] for column in key), []).append(position)
+
+    inserted = select(table.c.id, *(table.c[column] for column in key)) \
+        .where(table.c.id > floor, table.c[key[0]].in_({row[key[0]] for row in rows})).order_by(table.c.id)
+
+    ids = [None] * len(rows)
+    for row_id, *values in connection.execute(inserted):
+        waiting = positions.get(tuple(values))
+        if waiting:
+            ids[waiting.pop(0)] = row_id
+
+    if None in ids:
+        raise RuntimeError(f"could not read back the ids of the rows inserted into {table.name}")
+
+    return ids
+
+
+def _insert_blogs(rows, tags):
+    """Inserts (record, user) pairs with Core executemany statements: blogs, then their tag links, images, image links and
+    search rows. Timeline fan-out and stored file reference counts are done once for the whole list instead of per row
+    by the mapper events."""
+    connection = db.session.connection()
+    now = datetime.today()
+
+    blog_ids = _insert_many(connection, Blog.__table__, [{
+        "title": record["title"], "content": record["content"], "category": record["category"],
+        "author": user.username, "user_id": user.id, "published_date": record["published_date"] or now,
+    } for record, user in rows], ("user_id", "title"))
+
+    tag_links, search_rows, images, image_blog_ids = [], [], [], []
+    for blog_id, (record, user) in zip(blog_ids, rows):
+        blog_tags = list(dict.fromkeys(tags[normalize_tag(name)] for name in record["tags"] if normalize_tag(name)))
+        tag_links.extend({"blog_id": blog_id, "tag_id": tag.id} for tag in blog_tags)
+
+        search_rows.append({
+            "blog_id": blog_id, "title": record["title"], "content": record["content"],
+            "category": record["category"], "tags": " ".join(tag.name for tag in blog_tags),
+        })
+
+        for image in record["images"]:
+            images.append({"img_name": image.get("name"), "img_file_path": image["file"], "variants": []})
+            image_blog_ids.append(blog_id)
+
+    if tag_links:
+        connection.execute(insert(tag_blog), tag_links)
+    connection.execute(insert(BlogSearch.__table__), search_rows)
+
+    if images:
+        image_ids = _insert_many(connection, Image.__table__, images, ("img_file_path",))
+        connection.execute(insert(img_blog), [
+            {"blog_id": blog_id, "img_id": image_id} for blog_id, image_id in zip(image_blog_ids, image_ids)
+        ])
+        acquire_files(connection, Counter(image["img_file_path"] for image in images))
+
+    timeline.fan_out_many(connection, blog_ids)
+
+
+def _import_batch(batch):
+    """Inserts one batch of (line number, record) pairs. Returns the failures as (line number, error) pairs.
+    The whole batch is inserted in one savepoint; if that fails the records are retried one savepoint each so only the
+    broken ones are skipped."""
+    failures = []
+    parsed = []
+    for line_number, record in batch:
+        try:
+            parsed.append((line_number, _parse_blog(record)))
+        except ValueError as e:
+            failures.append((line_number, str(e)))
+
+    usernames = {record["author"] for _, record in parsed if record.get("author")}
+    user_ids = {record["user_id"] for _, record in parsed if record.get("user_id")}
+    users = User.query.filter(User.username.in_(usernames) | User.id.in_(user_ids)).all() if parsed else []
+    by_name = {user.username: user for user in users}
+    by_id = {user.id: user for user in users}
+
+    tags = _bulk_tags(name for _, record in parsed for name in record["tags"])
+
+    rows = []
+    for line_number, record in parsed:
+        user = by_id.get(record.get("user_id")) or by_name.get(record.get("author"))
+        if user is None:
+            failures.append((line_number, f"user '{record.get('author') or record.get('user_id')}' does not exist"))
+        else:
+            rows.append((line_number, record, user))
+
+    if rows:
+        try:
+            with db.session.begin_nested():
+                _insert_blogs([(record, user) for _, record, user in rows], tags)
+        except Exception:
+            for line_number, record, user in rows:
+                try:
+                    with db.session.begin_nested():
+                        _insert_blogs([(record, user)], tags)
+                except Exception as e:
+                    failures.append((line_number, str(e).splitlines()[0]))
+
+    db.session.commit()
+    return failures
+
+
+@click.command("import-blogs")
+@click.argument("source", type=click.File("r", encoding="utf-8"))
+@click.option("--batch-size", default=500, show_default=True, help="Number of blogs inserted per transaction.")
+@with_appcontext
+def import_blogs(source, batch_size):
+    """Imports blogs from an NDJSON file (or - for stdin), one JSON object per line:
+    {"title", "content", "category", "author" or "user_id", "tags": [...], "images": [...], "published_date"}.
+    Broken records are reported with their line number and skipped; the rest of their batch is still imported."""
+    imported = failed = 0
+    batch = []
+
+    def flush():
+        nonlocal imported, failed
+        failures = _import_batch(batch)
+        for line_number, error in sorted(failures):
+            click.echo(f"line {line_number}: {error}", err=True)
+
+        failed += len(failures)
+        imported += len(batch) - len(failures)
+        batch.clear()
+
+    for line_number, line in enumerate(source, start=1):
+        if not line.strip():
+            continue
+
+        try:
+            batch.append((line_number, json.loads(line)))
+        except ValueError as e:
+            click.echo(f"line {line_number}: invalid JSON ({e})", err=True)
+            failed += 1
+            continue
+
+        if len(batch) >= batch_size:
+            flush()
+
+    if batch:
+        flush()
+
+    click.echo(f"Imported {imported} blogs, {failed} failed.")
+
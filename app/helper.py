@@ -1,129 +1,357 @@
-from flask import jsonify, request, current_app
-from sqlalchemy import func
+from flask import jsonify, request, current_app, url_for, abort, make_response, stream_with_context
+from sqlalchemy import func, update, or_, and_
+from sqlalchemy.orm import selectinload
+from sqlalchemy.exc import IntegrityError
 from functools import wraps
+import math
+import json
+import base64
+from datetime import datetime, timedelta
 
 
-from datetime import datetime, timedelta, timezone
+from .models import db, Like, User, Follow, Blog, Comment, Reply, Tag
+from . import jwt
+from .cache import response_cache
+from .ratelimit import rate_limiter
+from .blocklist import revoked_tokens
 
 
-from .models import Like, User, InvalidToken, Follow
-from . import jwt
+def blog_feed_options():
+    """Loader options that fetch a page of blogs together with its comments, replies, their users and tags.
+    Every level is loaded with one extra query for the whole page instead of one query per row."""
+    comments = selectinload(Blog.comments)
+
+    return [
+        comments.joinedload(Comment.users),
+        comments.selectinload(Comment.replies).joinedload(Reply.users),
+        selectinload(Blog.tags),
+        selectinload(Blog.images),
+    ]
+
+
+def profile_blogs(user):
+    """Every blog of user, oldest first, loaded for the profile serializer."""
+    return Blog.query.options(*blog_feed_options()).filter(Blog.user_id == user.id).order_by(Blog.id).all()
+
+
+def follow_usernames(user):
+    """The PROFILE_FOLLOW_PREVIEW most recent usernames user follows and that follow user, newest follow first, with one query each.
+    The full lists are paged by /v1/user-profile/<id>/following and /followers."""
+    limit = current_app.config.get("PROFILE_FOLLOW_PREVIEW", 20)
+    following = db.session.query(User.username).join(Follow, Follow.followed_user_id == User.id) \
+        .filter(Follow.follower_user_id == user.id).order_by(Follow.id.desc()).limit(limit)
+    followers = db.session.query(User.username).join(Follow, Follow.follower_user_id == User.id) \
+        .filter(Follow.followed_user_id == user.id).order_by(Follow.id.desc()).limit(limit)
+
+    return [username for (username,) in following], [username for (username,) in followers]
+
+
+def get_like_totals(blog_ids=(), comment_ids=(), reply_ids=()):
+    """Returns the like totals of many blogs, comments and replies at once.
+    Runs one grouped query per entity type and returns three dicts (blogs, comments, replies) mapping ids to totals.
+    Ids without any like are left out of the dicts."""
+    totals = []
+    for column, ids in ((Like.blog_id, blog_ids), (Like.comment_id, comment_ids), (Like.reply_id, reply_ids)):
+        ids = set(ids)
+        if not ids:
+            totals.append({})
+            continue
+
+        query = Like.query.with_entities(column, func.sum(Like.like)).filter(column.in_(ids)).group_by(column)
+        totals.append(dict(query.all()))
 
-def get_blog_likes(blog):
+    return tuple(totals)
+
+
+class KeysetPage:
+    """A page of blogs fetched after a cursor instead of at an offset.
+    Mirrors the attributes of Flask-SQLAlchemy's Pagination that the routes read; page numbers do not exist in this mode."""
+    page = None
+    pages = None
+    has_prev = False
+    prev_num = None
+    next_num = None
+
+    def __init__(self, items, per_page, next_cursor, total=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.has_next = next_cursor is not None
+        self.total = total
+
+
+def encode_cursor(blog):
+    """Opaque cursor pointing just after blog in (published_date, id) order."""
+    position = json.dumps([blog.published_date.isoformat(), blog.id])
+    return base64.urlsafe_b64encode(position.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
     try:
-        total_likes = Like.query.with_entities(Like.blog_id, func.sum(Like.like)).filter_by(blog_id=blog.id).all()
+        published_date, blog_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.fromisoformat(published_date), int(blog_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor.")
+
+
+def keyset_paginate(query, cursor, per_page, with_total=False):
+    """Returns the page of blogs after cursor, newest first, ordered on (published_date, id).
+    The position is a range predicate served by the (published_date, id) index, so every page costs the same as the first.
+    Any ordering already on query is replaced, so relevance ordered searches come back newest first in this mode.
+    The total is only counted when with_total is set."""
+    ordered = query.order_by(None).order_by(Blog.published_date.desc(), Blog.id.desc())
 
-        likes = [like[1] for like in total_likes]
-        
-        return likes
-    
-    except Exception as e:
-        return jsonify({"error": str(e)})
-    
+    if cursor:
+        published_date, blog_id = decode_cursor(cursor)
+        ordered = ordered.filter(or_(
+            Blog.published_date < published_date,
+            and_(Blog.published_date == published_date, Blog.id < blog_id),
+        ))
+
+    items = ordered.limit(per_page + 1).all()
+    next_cursor = encode_cursor(items[per_page - 1]) if len(items) > per_page else None
+    total = query.order_by(None).count() if with_total else None
 
+    return KeysetPage(items[:per_page], per_page, next_cursor, total)
 
-def get_comment_likes(comment):
+
+def paginate_blogs(query, per_page):
+    """Paginates a Blog query the way the request asks for.
+    With a 'cursor' parameter (empty for the first page) it uses keyset pagination and counts the total only if 'count' is true,
+    always ordered newest first. Otherwise it falls back to page numbers and keeps the ordering of query, eg best match first."""
+    if "cursor" in request.args:
+        with_total = request.args.get("count", "false").lower() in ("1", "true", "yes")
+        try:
+            return keyset_paginate(query, request.args.get("cursor"), per_page, with_total)
+        except ValueError as e:
+            abort(make_response(jsonify({"error": str(e)}), 400))
+
+    return query.paginate(page=request.args.get("page", 1, type=int), per_page=per_page, error_out=False)
+
+
+def page_urls(blogs):
+    """Next and previous page urls of the current route, keeping the other query parameters of the request."""
+    args = request.args.to_dict(flat=False)
+
+    if isinstance(blogs, KeysetPage):
+        args["cursor"] = blogs.next_cursor
+        next_url = url_for(request.endpoint, **args) if blogs.has_next else None
+        return next_url, None
+
+    args.pop("page", None)
+    next_url = url_for(request.endpoint, page=blogs.next_num, **args) if blogs.has_next else None
+    prev_url = url_for(request.endpoint, page=blogs.prev_num, **args) if blogs.has_prev else None
+
+    return next_url, prev_url
+
+
+def next_cursor(blogs):
+    """The cursor of the next page in keyset mode, None for page-numbered results."""
+    return blogs.next_cursor if isinstance(blogs, KeysetPage) else None
+
+
+def list_rows(key, query, id_column, serialize_rows, per_page=50, max_per_page=500, batch_size=1000):
+    """Answers a listing route from query, ordered by id_column, with serialize_rows turning a list of rows into dicts.
+
+    By default it returns one page after the 'cursor' parameter (the last id of the previous page), 'limit' rows long.
+    With stream=true every row is sent instead: the rows are read in batch_size batches after the last id of the previous batch
+    and written out as they are serialized, so memory stays flat however big the table is. Each batch is a complete query,
+    so serialize_rows may run its own queries on the connection (a server-side cursor would still hold it on MySQL)."""
+    if request.args.get("stream", "false").lower() in ("1", "true", "yes"):
+        def generate():
+            yield "{" + json.dumps(key) + ": ["
+
+            first = True
+            last_id = 0
+            while batch := query.filter(id_column > last_id).order_by(id_column).limit(batch_size).all():
+                last_id = batch[-1].id
+                for item in serialize_rows(batch):
+                    yield ("" if first else ",") + json.dumps(item)
+                    first = False
+
+            yield "]}"
+
+        return current_app.response_class(stream_with_context(generate()), mimetype="application/json")
+
+    cursor = request.args.get("cursor") or "0"
+    if not cursor.isdigit():
+        abort(make_response(jsonify({"error": "Invalid cursor."}), 400))
+    cursor = int(cursor)
+    per_page = max(1, min(request.args.get("limit", per_page, type=int), max_per_page))
+
+    rows = query.filter(id_column > cursor).order_by(id_column).limit(per_page + 1).all()
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+
+    next_cursor = rows[-1].id if has_next else None
+    #Path arguments win over query parameters of the same name, eg /user-profile/1/followers?id=2.
+    args = {**request.args.to_dict(), **request.view_args, "cursor": next_cursor}
+
+    return jsonify({
+        "Per_page": per_page,
+        "Has_next": has_next,
+        "Next": url_for(request.endpoint, **args) if has_next else None,
+        "Next_cursor": next_cursor,
+        key: serialize_rows(rows)
+    }), 200
+
+
+def published_range(date=None, date_from=None, date_to=None):
+    """Turns the p, from and to search parameters (YYYY-MM-DD) into a half-open [start, end) datetime range.
+    p selects a single day; from and to may be given alone for open-ended ranges. Missing bounds are None."""
     try:
-        total_likes = Like.query.with_entities(Like.comment_id, func.sum(Like.like)).filter_by(comment_id=comment.id).all()
+        if date:
+            start = datetime.strptime(date, "%Y-%m-%d")
+            return start, start + timedelta(days=1)
+
+        start = datetime.strptime(date_from, "%Y-%m-%d") if date_from else None
+        end = datetime.strptime(date_to, "%Y-%m-%d") + timedelta(days=1) if date_to else None
+    except ValueError:
+        raise ValueError("Dates must follow the YYYY-MM-DD format e.g (2025-06-12).")
+
+    if start and end and start >= end:
+        raise ValueError("'from' must not be after 'to'.")
+
+    return start, end
+
+
+def normalize_tag(name):
+    """Lower-cases a tag and collapses its whitespace so 'Python ' and 'python' are the same dictionary entry."""
+    return " ".join(str(name).split()).lower()
 
-        likes = [like[1] for like in total_likes]
-        
-        return likes
-    
-    except Exception as e:
-        return jsonify({"error": str(e)})
-    
 
+def get_or_create(model, lookup, **values):
+    """Returns the model row matching lookup (a dict of column values), inserting it with lookup and values when missing.
+    The insert runs in a savepoint, so a row created concurrently by another request is reused instead of failing.
+    That row is re-read with a locking read: MySQL's REPEATABLE READ snapshot, taken by earlier SELECTs, can't see it."""
+    row = model.query.filter_by(**lookup).one_or_none()
+    if row is not None:
+        return row
 
-def get_reply_likes(reply):
     try:
-        total_likes = Like.query.with_entities(Like.reply_id, func.sum(Like.like)).filter_by(reply_id=reply.id).all()
+        with db.session.begin_nested():
+            row = model(**lookup, **values)
+            db.session.add(row)
+    except IntegrityError:
+        row = model.query.filter_by(**lookup).with_for_update(read=True).one()
 
-        likes = [like[1] for like in total_likes]
-        
-        return likes
-    
-    except Exception as e:
-        return jsonify({"error": str(e)})
+    return row
 
 
-def serialize_replies(reply):
-    return {
-        "Reply": reply.replies,
-        "Reply user's name": reply.users.username,
-        "Reply Likes": get_reply_likes(reply),
-        "Replied": [serialize_replies(rep) for rep in reply.children]
-    }
+def get_or_create_tags(names):
+    """Returns the Tag rows for names, creating the missing ones with get_or_create. Existing tags are fetched with a single query."""
+    names = list(dict.fromkeys(normalize_tag(name) for name in names if normalize_tag(name)))
+    if not names:
+        return []
 
+    tags = {tag.name: tag for tag in Tag.query.filter(Tag.name.in_(names))}
 
-def cache(f):
-    cached = {}
-    count = {}
+    for name in names:
+        if name not in tags:
+            tags[name] = get_or_create(Tag, {"name": name})
 
-    @wraps(f)
-    def inner(*args, **kwargs):
+    return [tags[name] for name in names]
 
-        query = ""
-        param = request.args.items(multi=True)
 
-        for _, value in param:
-            query += value
+def change_like_count(connection, like, amount):
+    """Adds amount to the like_count of the blog, comment or reply the like belongs to.
+    The counter is updated in SQL on the given connection, so it commits or rolls back together with the like itself."""
+    for model, target_id in ((Blog, like.blog_id), (Comment, like.comment_id), (Reply, like.reply_id)):
+        if target_id is not None:
+            connection.execute(
+                update(model).where(model.id == target_id).values(like_count=model.like_count + amount)
+            )
 
-        if query:
-            if query in cached:
-                print(f"Returning {query} from memory")
-                return cached[query]
-            
-            if query not in count:
-                count[query] = {"count": 0}
 
-            count[query]["count"] += 1
+def change_follow_counts(connection, follow, amount):
+    """Adds amount to the follower_count of the followed user and the following_count of the follower, in the follow's transaction."""
+    connection.execute(
+        update(User).where(User.id == follow.followed_user_id).values(follower_count=User.follower_count + amount)
+    )
+    connection.execute(
+        update(User).where(User.id == follow.follower_user_id).values(following_count=User.following_count + amount)
+    )
 
-            if count[query]["count"] >=3:
-                print(f"Cachning {query} to memory")
-                result = f(*args, **kwargs)
 
-                cached[query] = result
+def load_reply_trees(comment_ids, max_depth=None):
+    """Serializes the reply threads of the given comments. Returns {comment_id: [top level replies]}, each reply holding its
+    answers under "Replied".
 
-                return result
-            
-        return f(*args, **kwargs)
-    return inner
+    Every reply of the comments is fetched with one query joined to its user, then linked to its parent in a single pass.
+    Parents are always older than their answers, so ordering by id sees each parent first. Nothing recurses, and answers
+    deeper than max_depth (REPLY_MAX_DEPTH by default) are left out so jsonify can't hit the recursion limit."""
+    if max_depth is None:
+        max_depth = current_app.config.get("REPLY_MAX_DEPTH", 50)
 
+    trees = {comment_id: [] for comment_id in comment_ids}
+    if not trees:
+        return trees
 
-def rate_limt(MAX_REQUEST=0, BANNED_TIME=0):
-    def decorator(f):
-        ip_book = {}
-        @wraps(f)
-        def inner(*args, **kwargs):
+    rows = db.session.query(
+        Reply.id, Reply.parent_reply_id, Reply.comment_id, Reply.replies, Reply.like_count, User.username
+    ).outerjoin(User, User.id == Reply.user_id).filter(Reply.comment_id.in_(trees)).order_by(Reply.id)
+
+    nodes = {}
+    depths = {}
+    for row in rows:
+        depth = depths[row.parent_reply_id] + 1 if row.parent_reply_id in depths else 0
+        depths[row.id] = depth
+
+        if depth > max_depth:
+            continue
+
+        node = nodes[row.id] = {
+            "Reply": row.replies,
+            "Reply user's name": row.username,
+            "Reply Likes": [row.like_count],
+            "Replied": []
+        }
+
+        parent = nodes.get(row.parent_reply_id)
+        if parent is not None:
+            parent["Replied"].append(node)
+        else:
+            trees[row.comment_id].append(node)
+
+    return trees
 
-            ip = request.remote_addr
-            now = datetime.now(timezone.utc)
 
-            if ip not in ip_book:
-                ip_book[ip] = {
-                    "count": 0,
-                    "first request": now,
-                    "banned until": None
-                }
+def cache(f):
+    """Caches successful responses of the route in the shared ResponseCache (see app/cache.py).
+    The key is the route plus every query parameter name and value, with the page number normalised, so q=python and c=python
+    are different entries and the first page is the same entry with or without page=1."""
+    @wraps(f)
+    def inner(*args, **kwargs):
+        params = sorted((name, value) for name, value in request.args.items(multi=True) if name != "page")
+        key = (request.endpoint, tuple(params), request.args.get("page", 1, type=int))
 
-            ip_book[ip]["count"] += 1
+        cached = response_cache.get(key)
+        if cached is not None:
+            body, status, mimetype = cached
+            return current_app.response_class(body, status=status, mimetype=mimetype)
 
-            if ip_book[ip]["banned until"] is not None and now < ip_book[ip]["banned until"]:
-                return jsonify({"Message": f"You are been temporarily banned. Try again after {BANNED_TIME} minutue(s)."}), 403
-            
+        response = current_app.make_response(f(*args, **kwargs))
+
+        if response.status_code == 200:
+            response_cache.set(key, (response.get_data(), response.status_code, response.mimetype))
+
+        return response
+    return inner
 
-            if now - ip_book[ip]["first request"] > timedelta(minutes=BANNED_TIME):
-                ip_book[ip] = {
-                    "count": 1,
-                    "first request": now,
-                    "banned until": None
-                }
 
-            if ip_book[ip]["count"] > MAX_REQUEST:
-                ip_book[ip]['banned until'] = now + timedelta(minutes=BANNED_TIME)
-                return jsonify({"Message": "You have exceeded the daily request limit on this route."}), 403
-            
+def rate_limt(MAX_REQUEST=0, BANNED_TIME=0):
+    """Allows each client ip MAX_REQUEST requests to the route per BANNED_TIME minutes, refilled gradually (token bucket).
+    Bucket state lives in the shared RateLimiter (see app/ratelimit.py), so the limit holds across worker processes."""
+    def decorator(f):
+        @wraps(f)
+        def inner(*args, **kwargs):
+            key = f"{request.endpoint}:{request.remote_addr}"
+            allowed, retry_after = rate_limiter.take(key, MAX_REQUEST, BANNED_TIME * 60)
+
+            if not allowed:
+                response = jsonify({"Message": f"You have exceeded the request limit on this route. Try again in {math.ceil(retry_after)} second(s)."})
+                response.headers["Retry-After"] = str(math.ceil(retry_after))
+                return response, 403
 
             return f(*args, **kwargs)
         
@@ -154,7 +382,7 @@ def get_user(id):
 def is_token_in_blocklist(data, decrypt):
     jti = decrypt['jti']
 
-    return InvalidToken.is_jti_valid(jti)
+    return revoked_tokens.is_revoked(jti)
 
 def validate_name(x):
     """
@@ -200,4 +428,34 @@ def valid_image_ext(img_name) -> bool:
         return False
     else:
         return True
-    
+
+
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", ("png",)),
+    (b"\xff\xd8\xff", ("jpg", "jpeg")),
+    (b"GIF87a", ("gif",)),
+    (b"GIF89a", ("gif",)),
+    (b"II*\x00", ("tiff",)),
+    (b"MM\x00*", ("tiff",)),
+    (b"8BPS", ("psd",)),
+    (b"%PDF-", ("pdf", "ai")),
+    (b"%!PS-Adobe", ("eps", "ai")),
+]
+
+
+def sniff_image_type(head, declared=None):
+    """Works out the file type from its first bytes instead of trusting the uploaded name.
+    Returns the extension to store the file under, preferring the declared one when the content fits it, or False when the
+    content is not a known image format. eg a PDF named logo.ai stays 'ai', a PNG named cat.jpg becomes 'png'."""
+    declared = declared.lower() if declared else None
+
+    for signature, extensions in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return declared if declared in extensions else extensions[0]
+
+    text = head.lstrip(b"\xef\xbb\xbf \t\r\n").lower()
+    if (text.startswith(b"<?xml") or text.startswith(b"<svg")) and b"<svg" in text:
+        return "svg"
+
+    return False
+
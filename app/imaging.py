@@ -0,0 +1,143 @@
+"""Resized variants of uploaded images.
+
+Once an upload is committed, its file is handed to a process pool that writes one re-encoded copy per entry in VARIANTS
+next to the original (in the same shard directory), named "<sha256>.<variant>.<ext>". The request thread never waits on Pillow.
+When the pool is done, every Image row pointing at the file records which variants exist, and
+`/v1/serve-images/<filename>?size=<variant>` serves them.
+
+Pillow is optional. Without it no variants are made and the original is always served.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import os
+import tempfile
+
+from sqlalchemy import event, update
+from sqlalchemy.orm import Session
+
+try:
+    from PIL import Image as PILImage, ImageOps
+except ImportError:
+    PILImage = None
+
+from .models import db, Image
+from .session_info import discard_on_rollback
+
+
+logger = logging.getLogger(__name__)
+
+#name: (longest side in pixels, output format or None to keep a web friendly version of the source format)
+VARIANTS = {
+    "thumb": (200, None),
+    "medium": (800, None),
+    "webp": (1600, "WEBP"),
+}
+RASTER_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "tiff", "psd"}
+EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}
+FORMATS = {extension: image_format for image_format, extension in EXTENSIONS.items()}
+
+
+def variant_filename(filename, variant):
+    """Name of a variant of filename, eg abc.png + thumb -> abc.thumb.png. The extension follows the encoded format."""
+    stem, _, extension = filename.rpartition(".")
+    image_format = VARIANTS[variant][1]
+
+    if image_format:
+        extension = EXTENSIONS[image_format]
+    else:
+        #Keeps transparency for formats that usually carry it, everything else becomes a jpeg.
+        extension = "png" if extension.lower() in ("png", "gif") else "jpg"
+
+    return f"{stem}.{variant}.{extension}"
+
+
+def render_variants(path):
+    """Writes every missing variant of the file at path next to it and returns the names of the variants that exist.
+    Runs inside the worker processes, so it must only touch the filesystem."""
+    directory, filename = os.path.split(path)
+    done = []
+
+    with PILImage.open(path) as source:
+        source = ImageOps.exif_transpose(source)
+
+        for variant, (size, _) in VARIANTS.items():
+            target = os.path.join(directory, variant_filename(filename, variant))
+            if os.path.exists(target):
+                done.append(variant)
+                continue
+
+            image_format = FORMATS[target.rpartition(".")[2]]
+            image = source.copy()
+            image.thumbnail((size, size))
+            if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            elif image.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+                image = image.convert("RGBA")
+
+            #Written beside the target and renamed so a half written variant is never served.
+            with tempfile.NamedTemporaryFile(dir=directory, prefix=".variant-", delete=False) as temp:
+                try:
+                    image.save(temp, format=image_format, optimize=True, quality=82)
+                except BaseException:
+                    temp.close()
+                    os.remove(temp.name)
+                    raise
+            os.replace(temp.name, target)
+            done.append(variant)
+
+    return done
+
+
+class ImageProcessor:
+    def __init__(self):
+        self.app = None
+        self._executor = None
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions["image_processor"] = self
+
+        if PILImage is None:
+            logger.warning("Pillow is not installed, image variants are disabled.")
+            return
+
+        if not event.contains(Session, "after_commit", _submit_on_commit):
+            event.listen(Session, "after_commit", _submit_on_commit)
+            discard_on_rollback("new_uploads")
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.app.config.get("IMAGE_WORKERS"))
+        return self._executor
+
+    def submit(self, filename, path):
+        """Queues the variants of an uploaded file. Formats Pillow can't rasterise (svg, pdf, eps, ai) are skipped."""
+        if PILImage is None or filename.rpartition(".")[2].lower() not in RASTER_EXTENSIONS:
+            return None
+
+        future = self.executor.submit(render_variants, path)
+        future.add_done_callback(lambda future: self._record(filename, future))
+        return future
+
+    def _record(self, filename, future):
+        if future.exception() is not None:
+            logger.warning("Could not make variants of %s: %s", filename, future.exception())
+            return
+
+        with self.app.app_context():
+            db.session.execute(update(Image).where(Image.img_file_path == filename).values(variants=future.result()))
+            db.session.commit()
+
+
+image_processor = ImageProcessor()
+
+
+def queue_variants(filename, path):
+    """Marks the file at path for variant generation once the current transaction commits."""
+    db.session.info.setdefault("new_uploads", {})[filename] = path
+
+
+def _submit_on_commit(session):
+    for filename, path in session.info.pop("new_uploads", {}).items():
+        image_processor.submit(filename, path)
@@ -1,15 +1,15 @@
 from flask_sqlalchemy import SQLAlchemy
-from flask import current_app
 
 from datetime import datetime
-import os
+import time
 
 db = SQLAlchemy()
 
 
 tag_blog = db.Table('tag_blog',
     db.Column('blog_id', db.Integer, db.ForeignKey('blog.id')),
-    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'))
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id')),
+    db.Index('ux_tag_blog_tag_id_blog_id', 'tag_id', 'blog_id', unique=True)
 )
 
 
@@ -27,25 +27,51 @@ class Blog(db.Model):
     category = db.Column(db.String(50), nullable=False)
     author = db.Column(db.String(100), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    published_date = db.Column(db.DateTime, default=datetime.today())
+    published_date = db.Column(db.DateTime, default=datetime.today)
+    like_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)
 
 
     images = db.relationship("Image", secondary=img_blog, backref="blogs", cascade="all, delete", lazy="joined")
     likes = db.relationship('Like', backref='blogs', cascade='all, delete')
     comments = db.relationship('Comment', backref='blogs', cascade='all, delete')
-    tags = db.relationship('Tag', secondary=tag_blog, backref='blogs', cascade='all, delete')
+    tags = db.relationship('Tag', secondary=tag_blog, backref='blogs')
     replies = db.relationship('Reply', backref='blogs', cascade='all, delete')
+    search_index = db.relationship('BlogSearch', uselist=False, cascade='all, delete-orphan')
+
+    __table_args__ = (
+        db.Index("ix_blog_published_date_id", "published_date", "id"),
+        db.Index("ix_blog_user_id_published_date", "user_id", "published_date", "id"),
+        db.Index("ix_blog_author_published_date", "author", "published_date", "id"),
+    )
 
     def __repr__(self):
         return "<Title - {}; Content - {}; Category - {}; Pub date - {};>".format(self.title, self.content, self.category, self.published_date)
     
 
 
+class BlogSearch(db.Model):
+    """Denormalized text of a blog (title, content, category and tag names) that the search index is built on.
+    MySQL indexes it with FULLTEXT indexes and SQLite mirrors it into the blog_fts FTS5 table, see app/search.py."""
+    __tablename__ = "blog_search"
+    blog_id = db.Column(db.Integer, db.ForeignKey('blog.id', ondelete='CASCADE'), primary_key=True)
+    title = db.Column(db.String(100), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    category = db.Column(db.String(50), nullable=False)
+    tags = db.Column(db.Text, nullable=False, default="")
+
+    __table_args__ = (
+        db.Index("ft_blog_search", "title", "content", "category", "tags", mysql_prefix="FULLTEXT").ddl_if(dialect="mysql"),
+        db.Index("ft_blog_search_category", "category", mysql_prefix="FULLTEXT").ddl_if(dialect="mysql"),
+    )
+
+
+
 class Tag(db.Model):
+    """A tag dictionary entry. Names are stored normalised (see normalize_tag in app/helper.py) and shared by every blog using them."""
     __tablename__ = "tag"
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
-    tag_date = db.Column(db.DateTime, default=datetime.today())
+    name = db.Column(db.String(100), nullable=False, unique=True, index=True)
+    tag_date = db.Column(db.DateTime, default=datetime.today)
 
     
     def __repr__(self):
@@ -56,11 +82,14 @@ class Tag(db.Model):
 class User(db.Model):
     __tablename__ = "user"
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(150), nullable=False)
+    username = db.Column(db.String(150), nullable=False, index=True)
     email = db.Column(db.String(50), nullable=False, unique=True)
     password = db.Column(db.String(500), nullable=False)
     profile_image = db.Column(db.String(300), nullable=True)
-    date_joined = db.Column(db.DateTime, default=datetime.today())
+    date_joined = db.Column(db.DateTime, default=datetime.today)
+    #Kept in step with the follow table by the Follow mapper events in app/routes.py.
+    follower_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)
+    following_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)
 
     likes = db.relationship('Like', backref='users', cascade='all, delete')
     comments = db.relationship('Comment', backref='users', cascade='all, delete')
@@ -84,9 +113,10 @@ class User(db.Model):
     )
 
     def profile_image_path(self):
-        """Returns the absoulte path to the profile image."""
+        """Returns the absoulte path to the profile image, wherever its shard is."""
         if self.profile_image:
-            return os.path.join(current_app.config["UPLOAD_PATH"], self.profile_image)
+            from .storage import resolve_path
+            return resolve_path(self.profile_image)
         
         return None
 
@@ -96,7 +126,21 @@ class Image(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     img_name = db.Column(db.String(100))
     img_file_path = db.Column(db.String(100), nullable=False)
-    img_date = db.Column(db.DateTime, default=datetime.today())
+    img_date = db.Column(db.DateTime, default=datetime.today)
+    #Names of the resized copies made by app/imaging.py, eg ["thumb", "medium", "webp"]. Empty until they are ready.
+    variants = db.Column(db.JSON, default=list)
+
+
+
+class StoredFile(db.Model):
+    """An uploaded file stored once under the sha256 of its bytes.
+    ref_count is the number of Image rows and profile pictures pointing at filename; the file is removed when it drops to zero."""
+    __tablename__ = "stored_file"
+    sha256 = db.Column(db.String(64), primary_key=True)
+    filename = db.Column(db.String(100), nullable=False, unique=True)
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)
+    created_date = db.Column(db.DateTime, default=datetime.today)
 
 
 
@@ -104,10 +148,11 @@ class Comment(db.Model):
     __tablename__ = "comment"
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
-    date_commented = db.Column(db.DateTime, default=datetime.today())
+    date_commented = db.Column(db.DateTime, default=datetime.today)
 
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     blog_id = db.Column(db.Integer, db.ForeignKey('blog.id'))
+    like_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)
 
     likes = db.relationship('Like', backref='comments', cascade='all, delete')
     replies = db.relationship('Reply', backref='comments', cascade='all, delete')
@@ -122,13 +167,14 @@ class Reply(db.Model):
     __tablename__ = "reply"
     id = db.Column(db.Integer, primary_key=True)
     replies = db.Column(db.Text, nullable=False)
-    replies_date = db.Column(db.DateTime, default=datetime.today())
+    replies_date = db.Column(db.DateTime, default=datetime.today)
 
 
     comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'))
     blog_id = db.Column(db.Integer, db.ForeignKey('blog.id'))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     parent_reply_id = db.Column(db.Integer, db.ForeignKey('reply.id'))
+    like_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)
 
     likes = db.relationship('Like', backref='replies', cascade='all, delete')
     children = db.relationship('Reply', backref=db.backref('parent', remote_side=[id]), cascade='all, delete-orphan')
@@ -142,7 +188,7 @@ class Like(db.Model):
     __tablename__ = "like"
     id = db.Column(db.Integer, primary_key=True)
     like = db.Column(db.Integer, default=1, nullable=False)
-    published_date = db.Column(db.DateTime, default=datetime.today())
+    published_date = db.Column(db.DateTime, default=datetime.today)
 
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'))
@@ -157,7 +203,7 @@ class Follow(db.Model):
     __tablename__ = "follow"
     id = db.Column(db.Integer, primary_key=True)
     follow = db.Column(db.Integer, default=1, nullable=False)
-    follow_date = db.Column(db.DateTime, default=datetime.today())
+    follow_date = db.Column(db.DateTime, default=datetime.today)
 
     follower_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     followed_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -165,11 +211,34 @@ class Follow(db.Model):
     follower_user = db.relationship("User", foreign_keys=[follower_user_id], back_populates="following")
     following_user = db.relationship("User", foreign_keys=[followed_user_id], back_populates="followers")
 
+    __table_args__ = (
+        db.Index("ix_follow_follower_user_id", "follower_user_id", "followed_user_id"),
+        db.Index("ix_follow_followed_user_id", "followed_user_id", "follower_user_id"),
+    )
+
+
+class TimelineEntry(db.Model):
+    """A blog in the home timeline of one of its author's followers, written when the blog is posted (fan-out on write).
+    published_date is copied from the blog so a page of a timeline is a range scan of one index. See app/timeline.py."""
+    __tablename__ = "timeline_entry"
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    blog_id = db.Column(db.Integer, db.ForeignKey('blog.id', ondelete='CASCADE'), primary_key=True)
+    published_date = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_timeline_entry_user_id_published_date", "user_id", "published_date", "blog_id"),
+        db.Index("ix_timeline_entry_blog_id", "blog_id"),
+    )
+
 
 class InvalidToken(db.Model):
+    """A revoked JWT. revoked_at and expires_at are Unix times; expires_at is the token's exp claim, after which the row
+    can be purged because the token is rejected anyway."""
     __tablename__ = "invalidtoken"
     id = db.Column(db.Integer, primary_key=True)
-    jti = db.Column(db.String(100), nullable=False)
+    jti = db.Column(db.String(100), nullable=False, unique=True, index=True)
+    revoked_at = db.Column(db.Integer, index=True, default=lambda: int(time.time()))
+    expires_at = db.Column(db.Integer, index=True)
 
 
     @classmethod
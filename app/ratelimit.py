@@ -0,0 +1,139 @@
+"""Token bucket rate limiting used by the `rate_limt` decorator in app/helper.py.
+
+Every (route, client ip) pair owns a bucket holding up to `capacity` tokens that refills at `rate` tokens per second.
+A request takes one token and is refused when the bucket is empty.
+A bucket that has refilled completely behaves exactly like a missing one. Each bucket therefore records when that happens
+and is dropped after it, so memory only holds clients that were active recently.
+
+RATELIMIT_STORAGE selects where buckets live:
+"memory" keeps them in this process behind striped locks.
+Any other value is the path of a SQLite file that all worker processes on the host share, so limits hold across gunicorn workers.
+"""
+from contextlib import closing
+import os
+import sqlite3
+import threading
+import time
+
+
+def _refill(tokens, updated, capacity, rate, now):
+    """Takes one token from a bucket. Returns (allowed, tokens left, when the bucket will be full, seconds to wait)."""
+    tokens = min(capacity, tokens + (now - updated) * rate)
+
+    if tokens >= 1:
+        tokens -= 1
+        return True, tokens, now + (capacity - tokens) / rate, 0
+
+    return False, tokens, now + (capacity - tokens) / rate, (1 - tokens) / rate
+
+
+class MemoryStore:
+    """Buckets kept in this process. Keys are spread over independently locked stripes so requests for different clients
+    rarely wait on each other. Each stripe drops its expired buckets every `sweep_every` requests."""
+
+    def __init__(self, stripes=32, sweep_every=256):
+        self._stripes = [(threading.Lock(), {}) for _ in range(stripes)]
+        self._sweep_every = sweep_every
+        self._counters = [0] * stripes
+
+    def take(self, key, capacity, rate, now):
+        index = hash(key) % len(self._stripes)
+        lock, buckets = self._stripes[index]
+
+        with lock:
+            tokens, updated, _ = buckets.get(key, (capacity, now, now))
+            allowed, tokens, full_at, retry_after = _refill(tokens, updated, capacity, rate, now)
+            buckets[key] = (tokens, now, full_at)
+
+            self._counters[index] += 1
+            if self._counters[index] >= self._sweep_every:
+                self._counters[index] = 0
+                for expired in [k for k, bucket in buckets.items() if bucket[2] <= now]:
+                    del buckets[expired]
+
+        return allowed, retry_after
+
+    def __len__(self):
+        return sum(len(buckets) for _, buckets in self._stripes)
+
+
+class SQLiteStore:
+    """Buckets kept in a SQLite file so every worker process sees the same counts.
+    Each take runs in a BEGIN IMMEDIATE transaction, which serialises concurrent writers across processes.
+    Expired buckets are deleted in bulk every `sweep_every` requests.
+    Connections are kept per thread and per process: a SQLite connection must never be used on both sides of a fork(),
+    eg when gunicorn --preload creates the app before forking its workers."""
+
+    def __init__(self, path, sweep_every=1000):
+        self.path = path
+        self._sweep_every = sweep_every
+        self._local = threading.local()
+        self._count = 0
+
+        with closing(sqlite3.connect(self.path, timeout=5, isolation_level=None)) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, expires REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_bucket_expires ON bucket (expires)")
+
+    def _connect(self):
+        #A connection inherited from the parent process stays in the dict unused; closing it would touch the parent's locks too.
+        connections = self._local.__dict__.setdefault("connections", {})
+        pid = os.getpid()
+        if pid not in connections:
+            connections[pid] = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        return connections[pid]
+
+    def take(self, key, capacity, rate, now):
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT tokens, updated FROM bucket WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+
+            allowed, tokens, full_at, retry_after = _refill(tokens, updated, capacity, rate, now)
+            connection.execute(
+                "INSERT INTO bucket (key, tokens, updated, expires) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated, expires = excluded.expires",
+                (key, tokens, now, full_at),
+            )
+
+            self._count += 1
+            if self._count >= self._sweep_every:
+                self._count = 0
+                connection.execute("DELETE FROM bucket WHERE expires <= ?", (now,))
+
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        return allowed, retry_after
+
+
+class RateLimiter:
+    def __init__(self):
+        self.store = None
+
+    def init_app(self, app):
+        storage = app.config.get("RATELIMIT_STORAGE", "memory")
+        self.store = MemoryStore() if storage == "memory" else SQLiteStore(storage)
+        app.extensions["rate_limiter"] = self
+
+    def take(self, key, capacity, period):
+        """Takes a token for key from a bucket of `capacity` tokens that refills completely every `period` seconds.
+        Returns (allowed, seconds to wait before the next token)."""
+        if period <= 0:
+            return True, 0
+
+        if capacity <= 0:
+            return False, period
+
+        if self.store is None:
+            self.store = MemoryStore()
+
+        return self.store.take(key, capacity, capacity / period, time.time())
+
+
+rate_limiter = RateLimiter()
@@ -1,19 +1,29 @@
-from flask import Blueprint, jsonify, request, abort, url_for, send_from_directory, current_app, render_template
+from flask import Blueprint, jsonify, request, abort, url_for, current_app, render_template, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_jwt_extended import create_access_token, get_jwt_identity, get_jwt, jwt_required
-from werkzeug.utils import secure_filename
-import uuid
-from sqlalchemy import event
+from sqlalchemy import event, inspect, select, exists
+from sqlalchemy.orm import aliased, lazyload, selectinload
 
-import os
 import json
+from datetime import datetime
 from itertools import zip_longest
 
-from .models import db, Blog, Tag, User, Comment, Reply, Like, InvalidToken, Follow, Image
-from .helper import get_blog_likes, serialize_replies, get_comment_likes, get_reply_likes, cache, get_user, rate_limt, validate_name, user_id_int, is_following, img_extension_finder, valid_image_ext
+from .models import db, Blog, Tag, User, Comment, Reply, Like, InvalidToken, Follow, Image, tag_blog
+from .search import index_blog, search_blogs
+from . import timeline
+from .cache import response_cache
+from .blocklist import revoked_tokens
+from .storage import save_upload, acquire_file, release_file, send_upload, resolve_path, UploadError
+from .imaging import variant_filename, VARIANTS
+from .serializers import serialize_blog, SEARCH_BLOG, TAG_SEARCH_BLOG, PROFILE_BLOG
+from .helper import load_reply_trees, list_rows, cache, get_user, rate_limt, validate_name, user_id_int, is_following, blog_feed_options, profile_blogs, follow_usernames, change_like_count, change_follow_counts, paginate_blogs, page_urls, next_cursor, published_range, normalize_tag, get_or_create_tags
 
 bp = Blueprint("bp", __name__)
 
+@bp.app_errorhandler(413)
+def upload_too_large(e):
+    return jsonify({"error": f"Request body is larger than the {current_app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB limit."}), 413
+
 @bp.route("/")
 def home():
     return render_template("index.html"), 200
@@ -48,42 +58,22 @@ def post_blog():
                 
                 if not image:
                     new_blog = Blog(title=title, content=content, category=category, author=user.username, user_id=user_id)
-                    for i in range(len(tag)):
-                        new_tag = Tag(name=tag[i])
-                        db.session.add(new_tag)
-                        new_blog.tags.append(new_tag)
-                
+                    new_blog.tags.extend(get_or_create_tags(tag or []))
+
+                    index_blog(new_blog)
                     db.session.add(new_blog)
 
                 else:
 
-                    #Check if the image name is already in the database.
-                    if secure_filename(image.filename) in [
-                        img.img_file_path for img in Image.query.all()
-                    ] or secure_filename(image.filename) in current_app.config["UPLOAD_PATH"]:
-                        unique_str = str(uuid.uuid4())[:8]
-                        image.filename = f"{unique_str}_{image.filename}"
-
-
-                    #Handles the uplaoding of the image
-                    img_filename = secure_filename(image.filename)
-
-                    img_etx = img_extension_finder(img_filename)
-
-                    if not img_etx:
-                        return jsonify({"error": "Upload a valid image."}), 400
-                    
-                    if not valid_image_ext(img_etx.lower()):
-                        return jsonify({"error": "Invalid image format. Please upload a valid image."}), 400
-                    
-                    image.save(os.path.join(current_app.config["UPLOAD_PATH"], img_filename))
+                    #Handles the uplaoding of the image. Identical files are stored once under their content hash.
+                    try:
+                        img_filename = save_upload(image)
+                    except UploadError as e:
+                        return jsonify({"error": str(e)}), e.status_code
 
                     new_blog = Blog(title=title, content=content, category=category, author=user.username, user_id=user_id)
 
-                    for i in range(len(tag)):
-                        new_tag = Tag(name=tag[i])
-                        db.session.add(new_tag)
-                        new_blog.tags.append(new_tag)
+                    new_blog.tags.extend(get_or_create_tags(tag or []))
                     
 
                     
@@ -91,6 +81,7 @@ def post_blog():
                     db.session.add(new_image)
                     new_blog.images.append(new_image)
 
+                    index_blog(new_blog)
                     db.session.add(new_blog)
 
             except Exception as e:
@@ -104,53 +95,57 @@ def post_blog():
 @bp.route("/blogs")
 @jwt_required()
 def view_blogs():
-    page = request.args.get("page", 1, type=int)
     per_page = 5
-    blogs = Blog.query.paginate(page=page, per_page=per_page, error_out=False)
+    blogs = paginate_blogs(Blog.query.options(*blog_feed_options()), per_page)
 
-    next_url = url_for("bp.view_blogs", page=blogs.next_num, per_page=per_page) if blogs.has_next else None
-    prev_url = url_for("bp.view_blogs", page=blogs.prev_num, per_page=per_page) if blogs.has_prev else None
+    next_url, prev_url = page_urls(blogs)
 
     return jsonify({
         "Page": blogs.page,
         "Per_page": per_page,
         "Total_ Pages": blogs.pages,
+        "Total": blogs.total,
         "Has_next": blogs.has_next,
         "Has_prev": blogs.has_prev,
         "Next": next_url,
         "Prev": prev_url,
-        "Blogs": [{
-            "id": blog.id,
-            "Title": blog.title,
-            "Content": blog.content,
-            "Category": blog.category,
-            "Blog Likes": get_blog_likes(blog),
-            "Author": blog.author,
-            "Author Id": blog.user_id,
-            "Images": [
-                url_for("bp.serve_images", filename=image.img_file_path, _external=True) for image in blog.images
-            ],
-            "Interactions": [{
-                "id": comment.id,
-                "Comment": comment.content,
-                "comment user id": comment.users.id,
-                "Comment user's name": comment.users.username,
-                "Comment Likes": get_comment_likes(comment),
-                "ReplyContent": [{
-                    "id": reply.id,
-                    "Reply": reply.replies,
-                    "Reply user id": reply.users.id,
-                    "Reply user's name": reply.users.username,
-                    "Reply Likes": get_reply_likes(reply)
-                } for reply in comment.replies]
-            } for comment in blog.comments],
-            "Date Pub": blog.published_date.strftime("%Y-%m-%d"),
-            "Tags": [tag.name for tag in blog.tags]
-        } for blog in blogs.items]
+        "Next_cursor": next_cursor(blogs),
+        "Blogs": [serialize_blog(blog) for blog in blogs.items]
     }), 200
 
 
 
+@bp.route("/export/blogs")
+@jwt_required()
+def export_blogs():
+    """Streams every blog, in id order, as newline-delimited JSON in the same shape as /v1/blogs.
+    since=<id> exports the blogs after that id and since=<YYYY-MM-DD> those published on or after that day, for incremental exports.
+    Blogs are read in batches of 'batch' rows after the last id of the previous batch, each batch loading its tags, images,
+    comments and replies with one query per relationship."""
+    since = request.args.get("since")
+    batch_size = max(1, min(request.args.get("batch", 500, type=int), 5000))
+
+    query = Blog.query.options(*blog_feed_options())
+
+    if since:
+        if since.isdigit():
+            query = query.filter(Blog.id > int(since))
+        else:
+            try:
+                query = query.filter(Blog.published_date >= datetime.fromisoformat(since))
+            except ValueError:
+                return jsonify({"error": "since must be a blog id or a date e.g (2025-06-12)."}), 400
+
+    def generate():
+        last_id = 0
+        while blogs := query.filter(Blog.id > last_id).order_by(Blog.id).limit(batch_size).all():
+            last_id = blogs[-1].id
+            for blog in blogs:
+                yield json.dumps(serialize_blog(blog)) + "\n"
+
+    return current_app.response_class(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
 @bp.route("/delete-blog/<int:blog_id>", methods=["DELETE"])
 @jwt_required()
 def delete_blog(blog_id: int) -> int:
@@ -175,16 +170,27 @@ def delete_blog(blog_id: int) -> int:
 @jwt_required()
 def delete_tag(tag_id: int) -> int:
     if request.method == "DELETE":
-        tag = Tag.query.filter_by(id=tag_id).first()
+        tag = Tag.query.filter_by(id=tag_id).first_or_404()
         user = get_jwt_identity()
 
-        user_id = [{
-            "id": blog.user_id
-        } for blog in tag.blogs]
+        #Tags are shared between blogs, so a user can only take a tag off their own blogs.
+        own_ids = select(tag_blog.c.blog_id).join(Blog, Blog.id == tag_blog.c.blog_id) \
+            .where(tag_blog.c.tag_id == tag.id, Blog.user_id == int(user))
+        own_blogs = Blog.query.options(lazyload(Blog.images), selectinload(Blog.tags), selectinload(Blog.search_index)) \
+            .filter(Blog.id.in_(own_ids)).all()
 
         try:
-            if int(user) == user_id[0]["id"]:
-                db.session.delete(tag)
+            if own_blogs:
+                still_used = db.session.query(
+                    exists().where(tag_blog.c.tag_id == tag.id, tag_blog.c.blog_id.not_in(own_ids))
+                ).scalar()
+
+                for blog in own_blogs:
+                    blog.tags.remove(tag)
+                    index_blog(blog)
+
+                if not still_used:
+                    db.session.delete(tag)
             else:
                 return jsonify({"error": "Can't delete a tag not made by you."})
         except Exception as e:
@@ -220,27 +226,14 @@ def add_user():
 
                     db.session.add(new_user)
                 else:
-                    #Checks if filepath already exists in the database
-                    if secure_filename(image.filename) in [
-                        img.profile_image for img in User.query.all()
-                    ]:
-                        unique_id = str(uuid.uuid4())[:8]
-
-                        image.filename = f"{unique_id}_{image.filename}"
-
-                    #Handles file uploads
-                    img_filename = secure_filename(image.filename)
-
-                    if img_filename:
-                        file_ext = img_extension_finder(img_filename)
-
-                        if not valid_image_ext(file_ext.lower()):
-                            return jsonify({"error": "File type not supported. Please upload a valid image"}), 400
-                        
-                        image.save(os.path.join(current_app.config["UPLOAD_PATH"], img_filename))
+                    #Handles file uploads. Identical files are stored once under their content hash.
+                    try:
+                        img_filename = save_upload(image)
+                    except UploadError as e:
+                        return jsonify({"error": str(e)}), e.status_code
 
-                        new_user = User(username=username, email=email, password=generate_password_hash(password), profile_image=img_filename)
-                        db.session.add(new_user)
+                    new_user = User(username=username, email=email, password=generate_password_hash(password), profile_image=img_filename)
+                    db.session.add(new_user)
                         
             except Exception as e:
                 db.session.rollback()
@@ -280,12 +273,12 @@ def login():
 @bp.route("/view-users")
 @rate_limt(MAX_REQUEST=3)
 def view_users():
-    users = User.query.all()
+    users = db.session.query(User.id, User.username, User.email)
 
-    return jsonify({"Users": [{
+    return list_rows("Users", users, User.id, lambda rows: [{
         "username": user.username,
         "email": user.email
-    } for user in users]}), 200
+    } for user in rows])
 
 
 
@@ -321,16 +314,18 @@ def add_comment(blog_id: int) -> int:
 @bp.route("/view-comment")
 @rate_limt(MAX_REQUEST=3)
 def view_comment():
-    comments = Comment.query.all()
+    comments = db.session.query(
+        Comment.id, Comment.content, Blog.title, Blog.content.label("blog_content"), User.username
+    ).outerjoin(Blog, Blog.id == Comment.blog_id).outerjoin(User, User.id == Comment.user_id)
 
-    return jsonify({"Comments": [{
+    return list_rows("Comments", comments, Comment.id, lambda rows: [{
         "Content": comment.content,
         "Blog": {
-            "Title": comment.blogs.title,
-            "Content": comment.blogs.content
+            "Title": comment.title,
+            "Content": comment.blog_content
         },
-        "User": comment.users.username
-    } for comment in comments]}), 200
+        "User": comment.username
+    } for comment in rows])
 
 
 @bp.route("/delete-comment/<int:comment_id>", methods=["DELETE"])
@@ -466,30 +461,40 @@ def delete_reply(reply_id: int) -> int:
 @bp.route("/view-reply")
 @jwt_required()
 def view_reply():
-    replies = Reply.query.all()
+    comment_user = aliased(User)
+    replies = db.session.query(
+        Reply.id, Reply.replies, Comment.content, comment_user.username.label("comment_user"), Blog.title, User.username
+    ).outerjoin(Comment, Comment.id == Reply.comment_id).outerjoin(comment_user, comment_user.id == Comment.user_id) \
+     .outerjoin(Blog, Blog.id == Comment.blog_id).outerjoin(User, User.id == Reply.user_id)
 
-    return jsonify({"Replies": [{
+    return list_rows("Replies", replies, Reply.id, lambda rows: [{
         "Reply": reply.replies,
-        "Comment": reply.comments.content,
-        "Comment user": reply.comments.users.username,
-        "Blog": reply.comments.blogs.title,
-        "User": reply.users.username
-    } for reply in replies]}), 200
+        "Comment": reply.content,
+        "Comment user": reply.comment_user,
+        "Blog": reply.title,
+        "User": reply.username
+    } for reply in rows])
 
 
 @bp.route("/view-replies")
 @jwt_required()
 def view_replies():
-    comments = Comment.query.all()
+    comments = db.session.query(
+        Comment.id, Comment.content, Blog.title, User.username
+    ).outerjoin(Blog, Blog.id == Comment.blog_id).outerjoin(User, User.id == Comment.user_id)
 
-    return jsonify({
-        "Interactions": [{
-            "Blog": comment.blogs.title,
-            "Comment user's name": comment.users.username,
+    def serialize(rows):
+        #One reply query per page or streamed batch of comments.
+        replies = load_reply_trees([comment.id for comment in rows])
+
+        return [{
+            "Blog": comment.title,
+            "Comment user's name": comment.username,
             "Comment": comment.content,
-            "Replies interactions": [serialize_replies(r) for r in comment.replies if r.parent_reply_id is None]
-        } for comment in comments]
-    }), 200
+            "Replies interactions": replies[comment.id]
+        } for comment in rows]
+
+    return list_rows("Interactions", comments, Comment.id, serialize)
 
 
 
@@ -605,19 +610,19 @@ def search_blog():
     author = request.args.get("a")
     title = request.args.get("q")
     date = request.args.get("p")
+    date_from = request.args.get("from")
+    date_to = request.args.get("to")
     category = request.args.get("c")
     tags = request.args.get("t")
 
-    page = request.args.get("page", 1, type=int)
     per_page = 5
 
     if title and author and category:
-        blogs = Blog.query.filter(Blog.title.ilike(title), Blog.author.ilike(author), Blog.category.ilike(category)).paginate(page=page, per_page=per_page, error_out=False)
+        blogs = paginate_blogs(Blog.query.options(*blog_feed_options()).filter(Blog.title.ilike(title), Blog.author.ilike(author), Blog.category.ilike(category)), per_page)
 
         if blogs:
             
-            next_url = url_for("bp.search_blog", page=blogs.next_num, per_page=per_page) if blogs.has_next else None
-            prev_url = url_for("bp.search_blog", page=blogs.prev_num, per_page=per_page) if blogs.has_prev else None
+            next_url, prev_url = page_urls(blogs)
             try:
                 return jsonify({
                     "Page": blogs.page,
@@ -625,30 +630,10 @@ def search_blog():
                     "Total blogs": blogs.total,
                     "Next": next_url,
                     "Prev": prev_url,
+                    "Next_cursor": next_cursor(blogs),
                     "Blog": [{
                         "Full Query": f"{title} | {category} | {author}",
-                        "results": [{
-                            "Id": blog.id,
-                            "Title": blog.title,
-                            "Category": blog.category,
-                            "Content": blog.content,
-                            "Blog Likes": get_blog_likes(blog),
-                            "Author": blog.author,
-                            "Interactions": [{
-                                "Comment Id": comment.id,
-                                "Comment": comment.content,
-                                "Comment username": comment.users.username,
-                                "Comment Likes": get_comment_likes(comment),
-                                "Replycontent": [{
-                                    "Reply Id": reply.id,
-                                    "Reply": reply.replies,
-                                    "Reply username": reply.users.username,
-                                    "Reply Likes": get_reply_likes(reply),
-                                } for reply in comment.replies]
-                            }for comment in blog.comments],
-                            "Tags": [tag.name for tag in blog.tags],
-                            "Published date": blog.published_date
-                        } for blog in blogs.items],
+                        "results": SEARCH_BLOG.dump_many(blogs.items),
                     "Message": f"These are all the results pertaining to your search query '{title} || {category} || {author}'."
                     }]
                 }), 200
@@ -659,10 +644,10 @@ def search_blog():
         
 
     elif title:
-        blogs = Blog.query.filter(Blog.title.ilike(f"%{title}%")).paginate(page=page, per_page=per_page, error_out=False)
+        #Best match first with page numbers. A cursor pages through the same matches newest first instead.
+        blogs = paginate_blogs(search_blogs(title).options(*blog_feed_options()), per_page)
 
-        next_url = url_for("bp.search_blog", page=blogs.next_num, per_page=per_page) if blogs.has_next else None
-        prev_url = url_for("bp.search_blog", page=blogs.prev_num, per_page=per_page) if blogs.has_prev else None
+        next_url, prev_url = page_urls(blogs)
 
         if blogs:
             try:
@@ -671,30 +656,10 @@ def search_blog():
                     "Per_page": per_page,
                     "Next": next_url,
                     "Prev": prev_url,
+                    "Next_cursor": next_cursor(blogs),
                     "Blog": [{
                         "q": title,
-                        "results": [{
-                            "Id": blog.id,
-                            "Title": blog.title,
-                            "Category": blog.category,
-                            "Content": blog.content,
-                            "Blog Likes": get_blog_likes(blog),
-                            "Author": blog.author,
-                            "Interactions": [{
-                                "Comment Id": comment.id,
-                                "Comment": comment.content,
-                                "Comment username": comment.users.username,
-                                "Comment Likes": get_comment_likes(comment),
-                                "Replycontent": [{
-                                    "Reply Id": reply.id,
-                                    "Reply": reply.replies,
-                                    "Reply username": reply.users.username,
-                                    "Reply Likes": get_reply_likes(reply),
-                                } for reply in comment.replies]
-                            }for comment in blog.comments],
-                            "Tags": [tag.name for tag in blog.tags],
-                            "Published date": blog.published_date
-                        } for blog in blogs.items],
+                        "results": SEARCH_BLOG.dump_many(blogs.items),
                     "Message": f"These are all the results pertaining to your search query '{title}'."
                     }]
                     
@@ -705,41 +670,21 @@ def search_blog():
             return jsonify({"Message": "No content with such title"}), 200
     
     elif tags:
-       tag = Tag.query.filter(Tag.name.ilike(f"%{tags}%")).paginate(page=page, per_page=per_page, error_out=False)
+       query = Blog.query.join(tag_blog, tag_blog.c.blog_id == Blog.id).join(Tag, Tag.id == tag_blog.c.tag_id).filter(Tag.name == normalize_tag(tags))
+       blogs = paginate_blogs(query.options(*blog_feed_options()).order_by(Blog.published_date.desc(), Blog.id.desc()), per_page)
 
-       next_url = url_for("bp.search_blog", page=blogs.next_num, per_page=per_page) if tag.has_next else None
-       prev_url = url_for("bp.search_blog", page=blogs.prev_num, per_page=per_page) if tag.has_prev else None
+       next_url, prev_url = page_urls(blogs)
        
-       if tag:
+       if blogs:
             try:
                 return jsonify({
-                    "Page": tag.page,
+                    "Page": blogs.page,
                     "Next": next_url,
                     "Prev": prev_url,
+                    "Next_cursor": next_cursor(blogs),
                     "Blog": [{
                         "t": tags,
-                        "result": [{
-                            "Id": blog.id,
-                            "Title": blog.title,
-                            "Category": blog.category,
-                            "Content": blog.content,
-                            "Blog Likes": get_blog_likes(blog),
-                            "Author": blog.author,
-                            "Published date": blog.published_date,
-                            "Interactions": [{
-                                "Comment Id": comment.id,
-                                "Comment": comment.content,
-                                "Comment username": comment.users.username,
-                                "Comment Likes": get_comment_likes(comment),
-                                "Replycontent": [{
-                                    "Reply Id": reply.id,
-                                    "Reply": reply.replies,
-                                    "Reply username": reply.users.username,
-                                    "Reply Likes": get_reply_likes(reply),
-                                } for reply in comment.replies]
-                            }for comment in blog.comments],
-                            "Tag": [tag.name for tag in blog.tags],
-                        } for t in tag.items for blog in t.blogs],
+                        "result": TAG_SEARCH_BLOG.dump_many(blogs.items),
                     "Message": f"These are all the results pertaining to your search query '{tags}'."
                     }]
                 }), 200
@@ -749,10 +694,9 @@ def search_blog():
             return jsonify({"Message": "No content with such tag"}), 200
         
     elif category:
-        blogs = Blog.query.filter(Blog.category.ilike(f"%{category}%")).paginate(page=page, per_page=per_page, error_out=False)
+        blogs = paginate_blogs(search_blogs(category, field="category").options(*blog_feed_options()), per_page)
 
-        next_url = url_for("bp.search_blog", page=blogs.next_num, per_page=per_page) if blogs.has_next else None
-        prev_url = url_for("bp.search_blog", page=blogs.prev_num, per_page=per_page) if blogs.has_prev else None
+        next_url, prev_url = page_urls(blogs)
 
         if blogs:
             try:
@@ -762,30 +706,10 @@ def search_blog():
                     "Total content": blogs.total,
                     "Next": next_url,
                     "Prev": prev_url,
+                    "Next_cursor": next_cursor(blogs),
                     "Blog": [{
                         "c": category,
-                        "results": [{
-                            "Id": blog.id,
-                            "Title": blog.title,
-                            "Category": blog.category,
-                            "Content": blog.content,
-                            "Blog Likes": get_blog_likes(blog),
-                            "Author": blog.author,
-                            "Interactions": [{
-                                "Comment Id": comment.id,
-                                "Comment": comment.content,
-                                "Comment username": comment.users.username,
-                                "Comment Likes": get_comment_likes(comment),
-                                "Replycontent": [{
-                                    "Reply Id": reply.id,
-                                    "Reply": reply.replies,
-                                    "Reply username": reply.users.username,
-                                    "Reply Likes": get_reply_likes(reply),
-                                } for reply in comment.replies]
-                            }for comment in blog.comments],
-                            "Tags": [tag.name for tag in blog.tags],
-                            "Published date": blog.published_date
-                        } for blog in blogs.items],
+                        "results": SEARCH_BLOG.dump_many(blogs.items),
                     "Message": f"These are all the results pertaining to your search query '{category}'."
                     }]
                 }), 200
@@ -796,35 +720,26 @@ def search_blog():
     
 
     elif author:
-        blogs = Blog.query.filter_by(author=author).all()
+        #Looks the author up by username and pages through their blogs on the (user_id, published_date, id) index.
+        #Blogs whose author has no matching account fall back to the (author, published_date, id) index.
+        author_ids = [user.id for user in User.query.with_entities(User.id).filter_by(username=author)]
+        query = Blog.query.filter(Blog.user_id.in_(author_ids)) if author_ids else Blog.query.filter_by(author=author)
 
-        if blogs:
+        blogs = paginate_blogs(query.options(*blog_feed_options()).order_by(Blog.published_date.desc(), Blog.id.desc()), per_page)
+
+        next_url, prev_url = page_urls(blogs)
+
+        if blogs.items:
             try:
                 return jsonify({
+                    "Page": blogs.page,
+                    "Per_page": per_page,
+                    "Next": next_url,
+                    "Prev": prev_url,
+                    "Next_cursor": next_cursor(blogs),
                     "Blog": [{
                         "a": author,
-                        "results": [{
-                            "Id": blog.id,
-                            "Title": blog.title,
-                            "Category": blog.category,
-                            "Content": blog.content,
-                            "Blog Likes": get_blog_likes(blog),
-                            "Author": blog.author,
-                            "Interactions": [{
-                                "Comment Id": comment.id,
-                                "Comment": comment.content,
-                                "Comment username": comment.users.username,
-                                "Comment Likes": get_comment_likes(comment),
-                                "Replycontent": [{
-                                    "Reply Id": reply.id,
-                                    "Reply": reply.replies,
-                                    "Reply username": reply.users.username,
-                                    "Reply Likes": get_reply_likes(reply),
-                                } for reply in comment.replies]
-                            }for comment in blog.comments],
-                            "Tags": [tag.name for tag in blog.tags],
-                            "Published date": blog.published_date
-                        } for blog in blogs],
+                        "results": SEARCH_BLOG.dump_many(blogs.items),
                     "Message": f"These are all the results pertaining to your search query '{author}'."
                     }]
                 }), 200
@@ -833,40 +748,31 @@ def search_blog():
         else:
             return jsonify({"Message": "No content by such author"}), 200
         
-    elif date:
-        blogs = Blog.query.paginate(page=page, per_page=per_page, error_out=False)
+    elif date or date_from or date_to:
+        try:
+            start, end = published_range(date, date_from, date_to)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        query = Blog.query.options(*blog_feed_options())
+        if start:
+            query = query.filter(Blog.published_date >= start)
+        if end:
+            query = query.filter(Blog.published_date < end)
+
+        date = date or f"{date_from or ''}..{date_to or ''}"
+        blogs = paginate_blogs(query.order_by(Blog.published_date.desc(), Blog.id.desc()), per_page)
 
-        next_url = url_for("bp.search_blog", page=blogs.next_num, per_page=per_page) if blogs.has_next else None
-        prev_url = url_for("bp.search_blog", page=blogs.prev_num, per_page=per_page) if blogs.has_prev else None
+        next_url, prev_url = page_urls(blogs)
 
         try:
             result = [{
                 "Page": blogs.page,
                 "Next": next_url,
                 "Prev": prev_url,
+                "Next_cursor": next_cursor(blogs),
                 "p": date,
-                "results": [{
-                    "Id": blog.id,
-                    "Title": blog.title,
-                    "Category": blog.category,
-                    "Content": blog.content,
-                    "Blog Likes": get_blog_likes(blog),
-                    "Author": blog.author,
-                    "Interactions": [{
-                        "Comment Id": comment.id,
-                        "Comment": comment.content,
-                        "Comment username": comment.users.username,
-                        "Comment Likes": get_comment_likes(comment),
-                        "Replycontent": [{
-                            "Reply Id": reply.id,
-                            "Reply": reply.replies,
-                            "Reply username": reply.users.username,
-                            "Reply Likes": get_reply_likes(reply),
-                            } for reply in comment.replies]
-                    }for comment in blog.comments],
-                    "Tags": [tag.name for tag in blog.tags],
-                    "Published date": blog.published_date
-                } for blog in blogs.items if blog.published_date.strftime("%Y-%m-%d") == date],
+                "results": SEARCH_BLOG.dump_many(blogs.items),
                 "Message": f"These are all the results pertaining to your search query '{date}'."
             }]
             
@@ -883,20 +789,41 @@ def search_blog():
         return jsonify({
             "Notice": "Missing search parameters.",
             "How to query the API": [{
-                "q": "for blog title query; assuming you know the title of the blog",
+                "q": "full-text query over blog title, content, category and tags; best matches come first",
                 "t": "query by tag",
                 "c": "query by category",
                 "a": "query by author",
-                "p": "query by published date. NOTE: date must follow this standard (yy-mm-dd) e.g (2025-06-12)"
+                "p": "query by published date. NOTE: date must follow this standard (yy-mm-dd) e.g (2025-06-12)",
+                "from, to": "query by a range of published dates, either bound may be left out. Same date standard as p"
             }],
             "Full query": "You can add q,c,a query parameter for specific query."
         }), 400
     
+@bp.route("/cache-stats")
+@jwt_required()
+def cache_stats():
+    """Hit, miss and eviction counters of this worker's response cache."""
+    return jsonify(response_cache.stats()), 200
+
+
 @bp.route("/serve-images/<filename>")
 @jwt_required()
 def serve_images(filename):
-    """This route serves images to any other routes that requires images."""
-    return send_from_directory(current_app.config["UPLOAD_PATH"], filename)
+    """This route serves images to any other routes that requires images.
+    ?size=thumb|medium|webp returns a resized copy. The original is served until that copy has been made."""
+    size = request.args.get("size")
+
+    if size:
+        if size not in VARIANTS:
+            return jsonify({"error": f"Unknown size. Use one of {', '.join(VARIANTS)}."}), 400
+
+        variant = variant_filename(filename, size)
+        if resolve_path(variant) is None:
+            #The resized copy isn't ready yet, so the original must not be cached under this url for long.
+            return send_upload(filename, immutable=False)
+        filename = variant
+
+    return send_upload(filename)
 
 
 @bp.route("/user-profile/<int:id>", methods=["GET"])
@@ -911,33 +838,19 @@ def profile(id=None):
         try:
 
             profile_photo_url = (url_for("bp.serve_images", filename=user.profile_image, _external=True) if user.profile_image else None)
+            following, followers = follow_usernames(user)
 
             return jsonify({
                 "Username": user.username,
                 "Email": user.email,
                 "Profile Photo": profile_photo_url,
-                "Following": [following.following_user.username for following in user.following.all()],
-                "Followers": [follower.follower_user.username for follower in user.followers.all()],
-                "Blogs": [{
-                "Title": blog.title,
-                "Category": blog.category,
-                "Content": blog.content,
-                "Tag": [tag.name for tag in blog.tags],
-                "Blog Likes": get_blog_likes(blog), 
-                "Interactions": [{
-                    "Comment": comment.content,
-                    "Comment Id": comment.id,
-                    "Comment username": comment.users.username,
-                    "Comment Likes": get_comment_likes(comment),
-                    "Comment Reply": [{
-                        "Reply Id": reply.id,
-                        "Reply": reply.replies,
-                        "Reply username": reply.users.username,
-                        "Reply Likes": get_reply_likes(reply)
-                    } for reply in comment.replies],
-                } for comment in blog.comments],
-                "Blog date": blog.published_date
-            } for blog in user.blogs_posts]
+                "Following count": user.following_count,
+                "Followers count": user.follower_count,
+                "Following url": url_for("bp.following_list", id=user.id, _external=True),
+                "Followers url": url_for("bp.followers_list", id=user.id, _external=True),
+                "Following": following,
+                "Followers": followers,
+                "Blogs": PROFILE_BLOG.dump_many(profile_blogs(user))
             }), 200
         except Exception as e:
             return jsonify({"error": str(e)}), 500
@@ -951,39 +864,50 @@ def profile(id=None):
 
     try:
         profile_photo_url = (url_for("bp.serve_images", filename=user.profile_image, _external=True) if user.profile_image else None)
+        following, followers = follow_usernames(user)
 
         return jsonify({
             "Username": user.username,
             "Email": user.email,
             "Profile Photo": profile_photo_url,
-            "Following": [following.following_user.username for following in user.following.all()],
-            "Followers": [follower.follower_user.username for follower in user.followers.all()],
-            "Blogs": [{
-                "Id": blog.id,
-                "Title": blog.title,
-                "Category": blog.category,
-                "Content": blog.content,
-                "Tag": [tag.name for tag in blog.tags],
-                "Blog Likes": get_blog_likes(blog), 
-                "Interactions": [{
-                    "Comment": comment.content,
-                    "Comment Id": comment.id,
-                    "Comment username": comment.users.username,
-                    "Comment Likes": get_comment_likes(comment),
-                    "Comment Reply": [{
-                        "Reply Id": reply.id,
-                        "Reply": reply.replies,
-                        "Reply username": reply.users.username,
-                        "Reply Likes": get_reply_likes(reply)
-                    } for reply in comment.replies],
-                } for comment in blog.comments],
-                "Blog date": blog.published_date
-            } for blog in user.blogs_posts]
+            "Following count": user.following_count,
+            "Followers count": user.follower_count,
+            "Following url": url_for("bp.following_list", id=user.id, _external=True),
+            "Followers url": url_for("bp.followers_list", id=user.id, _external=True),
+            "Following": following,
+            "Followers": followers,
+            "Blogs": PROFILE_BLOG.dump_many(profile_blogs(user))
         }), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+@bp.route("/user-profile/<int:id>/followers", methods=["GET"])
+@jwt_required()
+def followers_list(id):
+    """Users following id, oldest follow first. Paginated with cursor/limit like /v1/view-users, stream=true sends them all."""
+    followers = db.session.query(Follow.id, User.id.label("user_id"), User.username) \
+        .join(User, User.id == Follow.follower_user_id).filter(Follow.followed_user_id == id)
+
+    return list_rows("Followers", followers, Follow.id, lambda rows: [{
+        "id": row.user_id,
+        "username": row.username
+    } for row in rows])
+
+
+@bp.route("/user-profile/<int:id>/following", methods=["GET"])
+@jwt_required()
+def following_list(id):
+    """Users id follows, oldest follow first. Paginated like followers_list."""
+    following = db.session.query(Follow.id, User.id.label("user_id"), User.username) \
+        .join(User, User.id == Follow.followed_user_id).filter(Follow.follower_user_id == id)
+
+    return list_rows("Following", following, Follow.id, lambda rows: [{
+        "id": row.user_id,
+        "username": row.username
+    } for row in rows])
+
+
 @bp.route("/search-author", methods=["GET"])
 @jwt_required()
 def search_author():
@@ -1098,22 +1022,11 @@ def update_profile_pic():
         if not image:
             return jsonify({"error": "An image is required. Please try uploading an image."}), 400
         
-        #Checks if picture with the same name already exists in the database.
-        if secure_filename(image.filename) in [
-            img.profile_image for img in User.query.all()
-        ]:
-            unique_code = str(uuid.uuid4())[:8]
-            image.filename = f"{unique_code}_{image.filename}"
-
-        #Handles the updating of profile picture.
-        img_filename = secure_filename(image.filename)
-
-        img_ext = img_extension_finder(img_filename)
-
-        if not valid_image_ext(img_ext.lower()):
-            return jsonify({"error": "Invalid image format. Please provide a valid image format."}), 400
-        
-        image.save(os.path.join(current_app.config["UPLOAD_PATH"], img_filename))
+        #Handles the updating of profile picture. Identical files are stored once under their content hash.
+        try:
+            img_filename = save_upload(image)
+        except UploadError as e:
+            return jsonify({"error": str(e)}), e.status_code
 
         user = get_user(user_id)
 
@@ -1185,38 +1098,112 @@ def follow(id):
         return is_follow
 
 
+@bp.route("/timeline")
+@jwt_required()
+def home_timeline():
+    """Blogs of the users the caller follows, and the caller's own, newest first. Pass Next_cursor as cursor for the next page."""
+    user_id = user_id_int(get_jwt_identity())
+    if not user_id:
+        abort(401)
+
+    per_page = 10
+    try:
+        blogs = timeline.read_timeline(user_id, request.args.get("cursor"), per_page)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({
+        "Per_page": per_page,
+        "Has_next": blogs.has_next,
+        "Next": url_for("bp.home_timeline", cursor=blogs.next_cursor) if blogs.has_next else None,
+        "Next_cursor": blogs.next_cursor,
+        "Blogs": [serialize_blog(blog) for blog in blogs.items]
+    }), 200
+
+
 @bp.route('/logout', methods=["POST"])
 @jwt_required()
 def logout():
     jti = get_jwt()['jti']
+    expires_at = get_jwt().get('exp')
 
     try:
-        invalid_token = InvalidToken(jti=jti)
+        invalid_token = InvalidToken(jti=jti, expires_at=expires_at)
 
         db.session.add(invalid_token)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     else:
         db.session.commit()
+        revoked_tokens.add(jti, expires_at)
         return jsonify({"Message": "Logged out successfully."}), 200   
     
 
-@event.listens_for(User, "before_update")
-def delete_old_profile_image(mapper, connection, target):
-    old = User.query.get(target.id)
+@event.listens_for(User, "after_insert")
+def count_new_profile_image(mapper, connection, target):
+    acquire_file(connection, target.profile_image)
 
-    if old and old.profile_image != target.profile_image:
-        old_path = old.profile_image_path()
 
-        if old_path and os.path.exists(old_path):
-            os.remove(old_path)
+@event.listens_for(User, "after_update")
+def delete_old_profile_image(mapper, connection, target):
+    """Moves the reference from the old profile picture to the new one when it changes.
+    Only the attribute history is read, so other user updates cost nothing here and files are deleted after commit."""
+    history = inspect(target).attrs.profile_image.history
+
+    if history.has_changes():
+        for old_image in history.deleted:
+            release_file(connection, old_image)
+        for new_image in history.added:
+            acquire_file(connection, new_image)
 
 
 @event.listens_for(User, "after_delete")
 def delete_profile_picture(mapper, connection, target):
-    """Deletes the profile picture path ones the user is deleted."""
+    """Releases the profile picture once the user is deleted."""
+    release_file(connection, target.profile_image)
+    timeline.remove_user(connection, target)
+
+
+@event.listens_for(Blog, "after_insert")
+def fan_out_blog(mapper, connection, target):
+    timeline.fan_out(connection, target)
+
+
+@event.listens_for(Blog, "after_delete")
+def remove_blog_from_timelines(mapper, connection, target):
+    timeline.remove_blog(connection, target)
+
+
+@event.listens_for(Follow, "after_insert")
+def count_new_follower(mapper, connection, target):
+    """Counts the follow on both users and fills the follower's timeline with the latest blogs of the followed user."""
+    change_follow_counts(connection, target, 1)
+    timeline.backfill(connection, target)
+
+
+@event.listens_for(Follow, "after_delete")
+def count_lost_follower(mapper, connection, target):
+    change_follow_counts(connection, target, -1)
+
+
+@event.listens_for(Image, "after_insert")
+def count_new_image(mapper, connection, target):
+    acquire_file(connection, target.img_file_path)
+
+
+@event.listens_for(Image, "after_delete")
+def delete_image_file(mapper, connection, target):
+    """Releases the stored file of a deleted image, e.g. when its blog is deleted."""
+    release_file(connection, target.img_file_path)
+
+
+@event.listens_for(Like, "after_insert")
+def increment_like_count(mapper, connection, target):
+    """Keeps the like_count of the liked blog, comment or reply in step with the new like."""
+    change_like_count(connection, target, target.like)
 
-    file_path = target.profile_image_path()
 
-    if file_path and os.path.exists(file_path):
-        os.remove(file_path)
\ No newline at end of file
+@event.listens_for(Like, "after_delete")
+def decrement_like_count(mapper, connection, target):
+    """Takes a deleted like, including likes removed by cascades, off the like_count it was counted in."""
+    change_like_count(connection, target, -target.like)
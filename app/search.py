@@ -0,0 +1,98 @@
+"""Full-text search over blogs.
+
+Every blog has a BlogSearch row holding its title, content, category and tag names.
+On MySQL that table carries FULLTEXT indexes and is queried with MATCH ... AGAINST.
+On SQLite (local and test setups) triggers mirror it into the blog_fts FTS5 table, which is ranked with bm25().
+Any other database falls back to ILIKE scans over the same table.
+"""
+import re
+
+from sqlalchemy import DDL, event, text, false, or_
+from sqlalchemy.dialects.mysql import match
+
+from .models import db, Blog, BlogSearch
+
+
+SEARCH_FIELDS = ("title", "content", "category", "tags")
+#Fields that can be searched on their own. Each needs its own FULLTEXT index on MySQL, see BlogSearch.
+SINGLE_FIELDS = ("category",)
+
+
+_sqlite_fts = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS blog_fts USING fts5(
+        title, content, category, tags, content='blog_search', content_rowid='blog_id'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS blog_search_ai AFTER INSERT ON blog_search BEGIN
+        INSERT INTO blog_fts(rowid, title, content, category, tags) VALUES (new.blog_id, new.title, new.content, new.category, new.tags);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS blog_search_ad AFTER DELETE ON blog_search BEGIN
+        INSERT INTO blog_fts(blog_fts, rowid, title, content, category, tags) VALUES ('delete', old.blog_id, old.title, old.content, old.category, old.tags);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS blog_search_au AFTER UPDATE ON blog_search BEGIN
+        INSERT INTO blog_fts(blog_fts, rowid, title, content, category, tags) VALUES ('delete', old.blog_id, old.title, old.content, old.category, old.tags);
+        INSERT INTO blog_fts(rowid, title, content, category, tags) VALUES (new.blog_id, new.title, new.content, new.category, new.tags);
+    END""",
+]
+
+for statement in _sqlite_fts:
+    event.listen(BlogSearch.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
+event.listen(BlogSearch.__table__, "before_drop", DDL("DROP TABLE IF EXISTS blog_fts").execute_if(dialect="sqlite"))
+
+
+def index_blog(blog):
+    """Creates or refreshes the search row of a blog. The row is written with the blog on the next flush."""
+    tags = " ".join(tag.name for tag in blog.tags)
+
+    if blog.search_index is None:
+        blog.search_index = BlogSearch(title=blog.title, content=blog.content, category=blog.category, tags=tags)
+    else:
+        blog.search_index.title = blog.title
+        blog.search_index.content = blog.content
+        blog.search_index.category = blog.category
+        blog.search_index.tags = tags
+
+
+def _fts5_query(term, field):
+    """Turns free text into an FTS5 expression: every word becomes a quoted prefix term and the terms are OR-ed,
+    so that ranking rather than an exact match decides the order. Quoting keeps user input out of the FTS5 syntax."""
+    words = re.findall(r"\w+", term)
+    if not words:
+        return None
+
+    expression = " OR ".join(f'"{word}"*' for word in words)
+    if field:
+        return f"{field} : ({expression})"
+
+    return expression
+
+
+def search_blogs(term, field=None):
+    """Returns a Blog query matching term, best match first.
+    field restricts the search to one of SINGLE_FIELDS; by default all indexed text is searched."""
+    if field is not None and field not in SINGLE_FIELDS:
+        raise ValueError(f"Cannot search on '{field}'.")
+
+    dialect = db.engine.dialect.name
+    query = Blog.query.join(BlogSearch, BlogSearch.blog_id == Blog.id)
+
+    if dialect == "mysql":
+        columns = [getattr(BlogSearch, name) for name in ((field,) if field else SEARCH_FIELDS)]
+        relevance = match(*columns, against=term).in_natural_language_mode()
+
+        return query.filter(relevance).order_by(relevance.desc(), Blog.id.desc())
+
+    if dialect == "sqlite":
+        fts_query = _fts5_query(term, field)
+        if fts_query is None:
+            return Blog.query.filter(false())
+
+        matches = text(
+            "SELECT rowid AS blog_id, bm25(blog_fts) AS score FROM blog_fts WHERE blog_fts MATCH :query"
+        ).bindparams(query=fts_query).columns(blog_id=db.Integer, score=db.Float).subquery()
+
+        # bm25() is lower for better matches.
+        return Blog.query.join(matches, matches.c.blog_id == Blog.id).order_by(matches.c.score, Blog.id.desc())
+
+    columns = [getattr(BlogSearch, name) for name in ((field,) if field else SEARCH_FIELDS)]
+    return query.filter(or_(*[column.ilike(f"%{term}%") for column in columns])).order_by(Blog.id.desc())
@@ -0,0 +1,139 @@
+"""JSON shapes of blogs and their comments and replies, shared by every read route.
+
+Each shape is a Serializer built once at import: a tuple of (key, accessor) pairs where plain attributes are
+operator.attrgetter calls and nested lists point at another Serializer. Dumping an object is then one loop over that
+tuple, with no per-call introspection.
+Serializers only read attributes. Load the objects with helper.blog_feed_options first, or every relationship
+they touch becomes a lazy load.
+"""
+from operator import attrgetter
+
+from flask import url_for
+
+
+class Serializer:
+    def __init__(self, **fields):
+        self.fields = tuple((key, self._compile(source)) for key, source in fields.items())
+
+    @staticmethod
+    def _compile(source):
+        if isinstance(source, str):
+            return attrgetter(source)
+        return source
+
+    def dump(self, obj):
+        return {key: get(obj) for key, get in self.fields}
+
+    def dump_many(self, objs):
+        dump = self.dump
+        return [dump(obj) for obj in objs]
+
+    def renamed(self, **keys):
+        """A copy of this serializer with some keys renamed, eg renamed(Tags="Tag")."""
+        copy = Serializer()
+        copy.fields = tuple((keys.get(key, key), get) for key, get in self.fields)
+        return copy
+
+
+def many(attribute, serializer):
+    """Accessor dumping the list in attribute with serializer."""
+    get = attrgetter(attribute)
+    return lambda obj: serializer.dump_many(get(obj))
+
+
+def likes(obj):
+    return [obj.like_count]
+
+
+def tag_names(blog):
+    return [tag.name for tag in blog.tags]
+
+
+def image_urls(blog):
+    return [url_for("bp.serve_images", filename=image.img_file_path, _external=True) for image in blog.images]
+
+
+#/v1/blogs, /v1/timeline and /v1/export/blogs
+FEED_REPLY = Serializer(**{
+    "id": "id",
+    "Reply": "replies",
+    "Reply user id": "users.id",
+    "Reply user's name": "users.username",
+    "Reply Likes": likes,
+})
+
+FEED_COMMENT = Serializer(**{
+    "id": "id",
+    "Comment": "content",
+    "comment user id": "users.id",
+    "Comment user's name": "users.username",
+    "Comment Likes": likes,
+    "ReplyContent": many("replies", FEED_REPLY),
+})
+
+FEED_BLOG = Serializer(**{
+    "id": "id",
+    "Title": "title",
+    "Content": "content",
+    "Category": "category",
+    "Blog Likes": likes,
+    "Author": "author",
+    "Author Id": "user_id",
+    "Images": image_urls,
+    "Interactions": many("comments", FEED_COMMENT),
+    "Date Pub": lambda blog: blog.published_date.strftime("%Y-%m-%d"),
+    "Tags": tag_names,
+})
+
+#/v1/search results
+SEARCH_REPLY = Serializer(**{
+    "Reply Id": "id",
+    "Reply": "replies",
+    "Reply username": "users.username",
+    "Reply Likes": likes,
+})
+
+SEARCH_COMMENT = Serializer(**{
+    "Comment Id": "id",
+    "Comment": "content",
+    "Comment username": "users.username",
+    "Comment Likes": likes,
+    "Replycontent": many("replies", SEARCH_REPLY),
+})
+
+SEARCH_BLOG = Serializer(**{
+    "Id": "id",
+    "Title": "title",
+    "Category": "category",
+    "Content": "content",
+    "Blog Likes": likes,
+    "Author": "author",
+    "Interactions": many("comments", SEARCH_COMMENT),
+    "Tags": tag_names,
+    "Published date": "published_date",
+})
+
+TAG_SEARCH_BLOG = SEARCH_BLOG.renamed(Tags="Tag")
+
+#/v1/user-profile
+PROFILE_COMMENT = Serializer(**{
+    "Comment": "content",
+    "Comment Id": "id",
+    "Comment username": "users.username",
+    "Comment Likes": likes,
+    "Comment Reply": many("replies", SEARCH_REPLY),
+})
+
+PROFILE_BLOG = Serializer(**{
+    "Id": "id",
+    "Title": "title",
+    "Category": "category",
+    "Content": "content",
+    "Tag": tag_names,
+    "Blog Likes": likes,
+    "Interactions": many("comments", PROFILE_COMMENT),
+    "Blog date": "published_date",
+})
+
+
+serialize_blog = FEED_BLOG.dump
@@ -0,0 +1,25 @@
+"""Work that extensions queue in Session.info during a transaction and act on in after_commit.
+
+The response cache, the image processor and the file reaper each keep such a key. discard_on_rollback drops it when the
+transaction rolls back instead, so nothing is done for writes that never happened.
+"""
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+_keys = set()
+
+
+def discard_on_rollback(key):
+    """Removes session.info[key] whenever the outermost transaction of a session rolls back."""
+    _keys.add(key)
+
+    if not event.contains(Session, "after_soft_rollback", _discard):
+        event.listen(Session, "after_soft_rollback", _discard)
+
+
+def _discard(session, previous_transaction):
+    #Rolling back a savepoint leaves the outer transaction, and what it wrote, in place.
+    if previous_transaction.parent is None:
+        for key in _keys:
+            session.info.pop(key, None)
@@ -0,0 +1,332 @@
+"""Content-addressed storage for uploaded images.
+
+Uploads are streamed to a temporary file in fixed-size chunks while their sha256 is computed, then stored once as "<sha256>.<ext>".
+Uploading bytes that are already stored only reuses the existing StoredFile row, so no second copy is written.
+Files are spread over two levels of subdirectories named after the first hex digits of their hash (UPLOAD_PATH/ab/cd/<name>)
+so no directory grows past a few thousand entries. Files from before sharding are still found at UPLOAD_PATH/<name>.
+References are counted by the Image and User mapper events in app/routes.py through acquire_file and release_file.
+Files whose count drops to zero are deleted by the FileReaper thread after the transaction commits.
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+
+from flask import current_app, request, send_from_directory, make_response, abort
+from werkzeug.utils import secure_filename
+from sqlalchemy import select, update, delete, event, case
+from sqlalchemy.orm import Session
+
+from .models import db, StoredFile, Image, User
+from .helper import sniff_image_type, img_extension_finder, get_or_create
+from .imaging import queue_variants, variant_filename, VARIANTS
+from .session_info import discard_on_rollback
+
+
+CHUNK_SIZE = 64 * 1024
+TEMP_PREFIX = ".upload-"
+CONTENT_ADDRESSED = re.compile(r"^[0-9a-f]{64}\.\w+$")
+VARIANT_NAME = re.compile(r"^([0-9a-f]{64})\.(\w+)\.\w+$")
+HASH_PREFIX = re.compile(r"^([0-9a-f]{64})\.")
+SHARD = re.compile(r"^[0-9a-f]{2}$")
+
+logger = logging.getLogger(__name__)
+
+
+def shard_key(filename):
+    """Hex digits deciding the shard of a file. Content addressed names and their variants use their own hash, so a file
+    and its variants share a directory. Legacy names are spread by the md5 of the name."""
+    match = HASH_PREFIX.match(filename)
+    return match.group(1) if match else hashlib.md5(filename.encode()).hexdigest()
+
+
+def shard_dir(filename):
+    key = shard_key(filename)
+    return os.path.join(current_app.config["UPLOAD_PATH"], key[:2], key[2:4])
+
+
+def upload_path(filename):
+    """Where filename is written: UPLOAD_PATH/ab/cd/filename."""
+    return os.path.join(shard_dir(filename), filename)
+
+
+def flat_path(filename):
+    """Where files uploaded before sharding live until `flask shard-uploads` moves them."""
+    return os.path.join(current_app.config["UPLOAD_PATH"], filename)
+
+
+def resolve_path(filename):
+    """Returns the path of a stored file, or None when it doesn't exist.
+    The sharded path is checked again last so a file moved by shard-uploads between the two checks is still found."""
+    if not filename or os.path.basename(filename) != filename or filename.startswith("."):
+        return None
+
+    for path in (upload_path(filename), flat_path(filename), upload_path(filename)):
+        if os.path.isfile(path):
+            return path
+
+    return None
+
+
+def iter_uploads(directory=None, depth=0):
+    """Yields a DirEntry for every file in UPLOAD_PATH, flat or sharded, listing one directory at a time."""
+    directory = directory or current_app.config["UPLOAD_PATH"]
+
+    with os.scandir(directory) as entries:
+        subdirectories = []
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                yield entry
+            elif depth < 2 and entry.is_dir(follow_symlinks=False) and SHARD.match(entry.name):
+                subdirectories.append(entry.path)
+
+    for subdirectory in subdirectories:
+        yield from iter_uploads(subdirectory, depth + 1)
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class UploadError(Exception):
+    """Raised when an upload is refused. status_code is the HTTP status the route should answer with."""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def save_upload(file_storage):
+    """Streams an uploaded file into UPLOAD_PATH under its content hash and returns the stored filename.
+
+    The body is copied in UPLOAD_CHUNK_SIZE chunks to a temporary file next to the final location while being hashed.
+    The type is taken from the magic bytes of the first chunk. Uploads over MAX_IMAGE_SIZE are refused as soon as
+    they cross it. The finished file is fsynced and renamed into place atomically, so readers never see a partial image.
+    The StoredFile row is flushed right away so reference counting in the same flush can find it."""
+    config = current_app.config
+    chunk_size = config.get("UPLOAD_CHUNK_SIZE", CHUNK_SIZE)
+    max_size = config.get("MAX_IMAGE_SIZE")
+
+    stream = file_storage.stream
+    head = stream.read(chunk_size)
+
+    extension = sniff_image_type(head, img_extension_finder(secure_filename(file_storage.filename or "")))
+    if not extension or extension not in config["UPLOAD_EXTENSIONS"]:
+        raise UploadError("Invalid image format. Please upload a valid image.")
+
+    digest = hashlib.sha256()
+    size = 0
+
+    temp = tempfile.NamedTemporaryFile(dir=config["UPLOAD_PATH"], prefix=TEMP_PREFIX, delete=False)
+    try:
+        with temp:
+            chunk = head
+            while chunk:
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise UploadError(f"Image is larger than the {max_size // (1024 * 1024)} MB limit.", 413)
+
+                digest.update(chunk)
+                temp.write(chunk)
+                chunk = stream.read(chunk_size)
+
+            temp.flush()
+            os.fsync(temp.fileno())
+    except BaseException:
+        os.remove(temp.name)
+        raise
+
+    sha256 = digest.hexdigest()
+    stored = get_or_create(StoredFile, {"sha256": sha256}, filename=f"{sha256}.{extension}", size=size)
+
+    path = resolve_path(stored.filename)
+    if path and touch(path):
+        os.remove(temp.name)
+    else:
+        path = upload_path(stored.filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp.name, path)
+
+    queue_variants(stored.filename, path)
+    return stored.filename
+
+
+def touch(path):
+    """Marks a stored file as just used so the FileReaper and gc-uploads leave it alone for their grace period.
+    Returns False when the file is gone."""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def recently_touched(filename, grace_period):
+    path = resolve_path(filename)
+    try:
+        return path is not None and os.stat(path).st_mtime > time.time() - grace_period
+    except FileNotFoundError:
+        return False
+
+
+def acquire_file(connection, filename):
+    """Counts one more reference to filename. Files stored before content addressing have no row and are not counted."""
+    if filename:
+        connection.execute(
+            update(StoredFile).where(StoredFile.filename == filename).values(ref_count=StoredFile.ref_count + 1)
+        )
+
+
+def acquire_files(connection, counts):
+    """acquire_file for many references at once: counts maps filenames to the number of new references, in one UPDATE."""
+    if counts:
+        connection.execute(
+            update(StoredFile).where(StoredFile.filename.in_(counts))
+            .values(ref_count=StoredFile.ref_count + case(counts, value=StoredFile.filename, else_=0))
+        )
+
+
+def release_file(connection, filename):
+    """Drops one reference to filename and removes the file once nothing points at it any more.
+    Files stored before content addressing were never shared, so they are removed straight away."""
+    if not filename:
+        return
+
+    connection.execute(
+        update(StoredFile).where(StoredFile.filename == filename).values(ref_count=StoredFile.ref_count - 1)
+    )
+    ref_count = connection.execute(select(StoredFile.ref_count).where(StoredFile.filename == filename)).scalar()
+
+    if ref_count is not None and ref_count > 0:
+        return
+
+    if ref_count is not None:
+        connection.execute(delete(StoredFile).where(StoredFile.filename == filename))
+
+    remove_file(filename)
+
+
+def remove_file(filename):
+    """Schedules a stored file and its resized variants for deletion once the current transaction commits.
+    Nothing is removed if it rolls back."""
+    db.session.info.setdefault("pending_unlinks", set()).add(filename)
+
+
+def is_referenced(filename):
+    return db.session.query(
+        db.session.query(StoredFile).filter(StoredFile.filename == filename).exists()
+        | db.session.query(Image).filter(Image.img_file_path == filename).exists()
+        | db.session.query(User).filter(User.profile_image == filename).exists()
+    ).scalar()
+
+
+class FileReaper:
+    """Deletes released files on a background thread, so requests never wait on disk I/O.
+    Every file is checked again before it goes: the same bytes may have been uploaded and referenced meanwhile.
+    An upload reusing the file is not visible to that check until it commits, so files touched by save_upload within
+    FILE_REAPER_GRACE seconds are kept too. Those, and files still queued when the process exits, are left behind for
+    `flask gc-uploads`."""
+
+    def __init__(self):
+        self.app = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions["file_reaper"] = self
+
+        if not event.contains(Session, "after_commit", _unlink_on_commit):
+            event.listen(Session, "after_commit", _unlink_on_commit)
+            discard_on_rollback("pending_unlinks")
+
+    def schedule(self, filenames):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="file-reaper", daemon=True)
+                self._thread.start()
+
+        for filename in filenames:
+            self._queue.put(filename)
+
+    def join(self):
+        """Waits until every scheduled file has been handled."""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            filename = self._queue.get()
+            try:
+                with self.app.app_context():
+                    grace_period = self.app.config.get("FILE_REAPER_GRACE", 60)
+                    #The mtime is checked after the database, so an upload that touched the file in between is still seen.
+                    if not is_referenced(filename) and not recently_touched(filename, grace_period):
+                        for name in (filename, *(variant_filename(filename, variant) for variant in VARIANTS)):
+                            for path in (upload_path(name), flat_path(name)):
+                                if os.path.exists(path):
+                                    os.remove(path)
+            except Exception:
+                logger.exception("Could not remove %s", filename)
+            finally:
+                self._queue.task_done()
+
+
+file_reaper = FileReaper()
+
+
+def _unlink_on_commit(session):
+    filenames = session.info.pop("pending_unlinks", None)
+    if filenames:
+        file_reaper.schedule(filenames)
+
+
+def send_upload(filename, immutable=True):
+    """Sends a stored file with caching headers. Conditional (If-None-Match/If-Modified-Since) and Range requests are answered
+    by werkzeug. Content addressed names never change bytes, so their ETag is the hash and, when immutable is True, they are
+    cached for IMAGE_CACHE_MAX_AGE without revalidation. Legacy names get werkzeug's mtime/size ETag and must revalidate.
+
+    With IMAGE_ACCEL_REDIRECT set (eg "/protected-images/", an internal nginx location aliased to UPLOAD_PATH) only the
+    headers are sent and the proxy streams the file. USE_X_SENDFILE does the same for Apache/lighttpd through send_file."""
+    directory = current_app.config["UPLOAD_PATH"]
+    path = resolve_path(filename)
+    if path is None:
+        abort(404)
+    relative = os.path.relpath(path, directory).replace(os.sep, "/")
+
+    hashed = CONTENT_ADDRESSED.match(filename) or VARIANT_NAME.match(filename)
+    etag = filename.rsplit(".", 1)[0] if hashed else None
+    max_age = current_app.config.get("IMAGE_CACHE_MAX_AGE", 0) if hashed and immutable else 0
+
+    accel_prefix = current_app.config.get("IMAGE_ACCEL_REDIRECT")
+    if accel_prefix:
+        stat = os.stat(path)
+        response = make_response("")
+        response.mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        response.headers["X-Accel-Redirect"] = accel_prefix.rstrip("/") + "/" + relative
+        response.last_modified = stat.st_mtime
+        response.set_etag(etag or f"{stat.st_mtime}-{stat.st_size}")
+        response.make_conditional(request)
+    else:
+        response = send_from_directory(directory, relative, etag=etag if etag else True, max_age=max_age)
+
+    response.cache_control.public = True
+    if max_age:
+        response.cache_control.max_age = max_age
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+
+    return response
+
@@ -0,0 +1,105 @@
+"""Home timelines: the blogs of the users someone follows, newest first.
+
+When a blog is posted, one INSERT ... SELECT copies it into the timeline_entry rows of every follower of its author.
+Reading a timeline is then a range scan of (user_id, published_date, blog_id).
+Authors with more than TIMELINE_FANOUT_LIMIT followers are skipped at write time, because one post would write that many rows.
+Their blogs, and the reader's own, are read from the blog table through the (user_id, published_date, id) index and merged in.
+"""
+from collections import namedtuple
+
+from flask import current_app
+from sqlalchemy import select, insert, delete, or_, and_, literal
+
+from .models import db, Blog, User, Follow, TimelineEntry
+from .helper import KeysetPage, encode_cursor, decode_cursor, blog_feed_options
+
+
+Position = namedtuple("Position", "id published_date")
+
+
+def fanout_limit():
+    return current_app.config.get("TIMELINE_FANOUT_LIMIT", 10000)
+
+
+def fan_out(connection, blog):
+    """Writes blog into the timelines of its author's followers, unless the author has too many of them."""
+    follower_count = connection.execute(select(User.follower_count).where(User.id == blog.user_id)).scalar()
+    if not follower_count or follower_count > fanout_limit():
+        return
+
+    followers = select(Follow.follower_user_id, literal(blog.id), literal(blog.published_date)) \
+        .where(Follow.followed_user_id == blog.user_id).distinct()
+    connection.execute(insert(TimelineEntry).from_select(["user_id", "blog_id", "published_date"], followers))
+
+
+def fan_out_many(connection, blog_ids):
+    """fan_out for many blogs at once, eg a batch of imported blogs, with a single INSERT ... SELECT."""
+    followers = select(Follow.follower_user_id, Blog.id, Blog.published_date) \
+        .join(Follow, Follow.followed_user_id == Blog.user_id).join(User, User.id == Blog.user_id) \
+        .where(Blog.id.in_(blog_ids), User.follower_count > 0, User.follower_count <= fanout_limit()).distinct()
+    connection.execute(insert(TimelineEntry).from_select(["user_id", "blog_id", "published_date"], followers))
+
+
+def backfill(connection, follow):
+    """Copies the latest TIMELINE_BACKFILL blogs of a newly followed author into the follower's timeline."""
+    follower_count = connection.execute(select(User.follower_count).where(User.id == follow.followed_user_id)).scalar()
+    if follower_count is None or follower_count > fanout_limit():
+        return
+
+    latest = select(literal(follow.follower_user_id), Blog.id, Blog.published_date) \
+        .where(Blog.user_id == follow.followed_user_id, Blog.id.not_in(
+            select(TimelineEntry.blog_id).where(TimelineEntry.user_id == follow.follower_user_id)
+        )).order_by(Blog.published_date.desc(), Blog.id.desc()).limit(current_app.config.get("TIMELINE_BACKFILL", 50))
+    connection.execute(insert(TimelineEntry).from_select(["user_id", "blog_id", "published_date"], latest))
+
+
+def remove_blog(connection, blog):
+    connection.execute(delete(TimelineEntry).where(TimelineEntry.blog_id == blog.id))
+
+
+def remove_user(connection, user):
+    connection.execute(delete(TimelineEntry).where(TimelineEntry.user_id == user.id))
+
+
+def _after(column_date, column_id, cursor):
+    if not cursor:
+        return None
+
+    published_date, blog_id = decode_cursor(cursor)
+    return or_(column_date < published_date, and_(column_date == published_date, column_id < blog_id))
+
+
+def read_timeline(user_id, cursor=None, per_page=10):
+    """Returns the page of user_id's timeline after cursor as a KeysetPage of blogs.
+    Raises ValueError for a malformed cursor."""
+    entries = select(TimelineEntry.blog_id, TimelineEntry.published_date).where(TimelineEntry.user_id == user_id)
+    position = _after(TimelineEntry.published_date, TimelineEntry.blog_id, cursor)
+    if position is not None:
+        entries = entries.where(position)
+    entries = entries.order_by(TimelineEntry.published_date.desc(), TimelineEntry.blog_id.desc()).limit(per_page + 1)
+
+    #Fan-out on read for the authors that were too popular to fan out on write, plus the reader's own blogs.
+    hot = select(Follow.followed_user_id).join(User, User.id == Follow.followed_user_id) \
+        .where(Follow.follower_user_id == user_id, User.follower_count > fanout_limit())
+    authors = [user_id, *db.session.scalars(hot)]
+
+    pulled = select(Blog.id, Blog.published_date).where(Blog.user_id.in_(authors))
+    position = _after(Blog.published_date, Blog.id, cursor)
+    if position is not None:
+        pulled = pulled.where(position)
+    pulled = pulled.order_by(Blog.published_date.desc(), Blog.id.desc()).limit(per_page + 1)
+
+    #An author who crossed the limit can have blogs in both lists.
+    merged = {blog_id: published_date for blog_id, published_date in [*db.session.execute(entries), *db.session.execute(pulled)]}
+    ordered = sorted(merged.items(), key=lambda item: (item[1], item[0]), reverse=True)[:per_page + 1]
+
+    ids = [blog_id for blog_id, _ in ordered[:per_page]]
+    blogs = {blog.id: blog for blog in Blog.query.options(*blog_feed_options()).filter(Blog.id.in_(ids))} if ids else {}
+    items = [blogs[blog_id] for blog_id in ids if blog_id in blogs]
+
+    next_cursor = None
+    if len(ordered) > per_page:
+        blog_id, published_date = ordered[per_page - 1]
+        next_cursor = encode_cursor(Position(blog_id, published_date))
+
+    return KeysetPage(items, per_page, next_cursor)